@@ -15,6 +15,11 @@
 # limitations under the License.
 
 import os
+import json
+import shutil
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 from ultralytics import YOLO
 from sahi import AutoDetectionModel
@@ -22,6 +27,174 @@ from sahi.predict import get_sliced_prediction
 from tqdm import tqdm
 import argparse
 
+from image_writer import ImageWriter, tmp_path_for, reencodes, add_writer_args, writer_kwargs_from_args
+from sliced_detection import BatchedSlicedDetector
+from instrumentation import NULL_METRICS, add_metrics_args, metrics_from_args
+
+def load_detection_model(model_path, conf_threshold, device):
+    # Инициализация SAHI-модели
+    return AutoDetectionModel.from_pretrained(
+        model_type='yolov8',
+        model_path=model_path,
+        confidence_threshold=conf_threshold,
+        device=device
+    )
+
+
+def detect_objects(
+    image,
+    n_model,
+    slice_size,
+    overlap_ratio,
+    object_class_id,
+    output_class_id
+):
+    """
+    Run SAHI sliced inference on a BGR image and return YOLO-format
+    annotations (class_id, x_center, y_center, width, height) for object_class_id.
+    """
+    h, w = image.shape[:2]
+
+    # Слайсинг-инференс
+    result = get_sliced_prediction(
+        image,
+        n_model,
+        slice_height=slice_size,
+        slice_width=slice_size,
+        overlap_height_ratio=overlap_ratio,
+        overlap_width_ratio=overlap_ratio
+    )
+
+    # Сборка аннотаций
+    annotations = []
+    for obj in result.object_prediction_list:
+        if obj.category.id != object_class_id:
+            continue
+        xmin, ymin = obj.bbox.minx, obj.bbox.miny
+        xmax, ymax = obj.bbox.maxx, obj.bbox.maxy
+        x_center = ((xmin + xmax) / 2) / w
+        y_center = ((ymin + ymax) / 2) / h
+        width    = (xmax - xmin) / w
+        height   = (ymax - ymin) / h
+        annotations.append((output_class_id, x_center, y_center, width, height))
+    return annotations
+
+
+def write_labels(txt_path, annotations):
+    with open(txt_path, 'w') as f:
+        for cid, xc, yc, bw, bh in annotations:
+            f.write(f"{cid} {xc:.6f} {yc:.6f} {bw:.6f} {bh:.6f}\n")
+
+
+PROGRESS_NAME = 'progress.jsonl'
+
+
+def load_progress(label_out_dir):
+    """Return {image_name: status} for images already labeled or rejected."""
+    progress = {}
+    progress_path = os.path.join(label_out_dir, PROGRESS_NAME)
+    if not os.path.exists(progress_path):
+        return progress
+    with open(progress_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Последняя строка могла оборваться при падении процесса
+                continue
+            progress[record['image']] = record['status']
+    return progress
+
+
+class ProgressLog:
+    """
+    Append-only log of processed images, one JSON record per line.
+    mark() is thread-safe, so it can be called from ImageWriter callbacks.
+    """
+
+    def __init__(self, label_out_dir):
+        self._file = open(os.path.join(label_out_dir, PROGRESS_NAME), 'a')
+        self._lock = threading.Lock()
+
+    def mark(self, img_name, status):
+        with self._lock:
+            self._file.write(json.dumps({'image': img_name, 'status': status}, ensure_ascii=False) + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def prefetch_images(image_dir, img_names, num_workers=4, prefetch=16, metrics=NULL_METRICS):
+    """
+    Decode images in a thread pool, up to `prefetch` images ahead of the
+    consumer. Yields (img_name, image) in the order of img_names; image is
+    None if the file could not be read.
+    """
+    def read(img_name):
+        with metrics.stage('decode', img_name):
+            return cv2.imread(os.path.join(image_dir, img_name))
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending = deque()
+        names = iter(img_names)
+        for img_name in names:
+            pending.append((img_name, executor.submit(read, img_name)))
+            if len(pending) >= prefetch:
+                break
+        while pending:
+            img_name, future = pending.popleft()
+            # cv2.imread отпускает GIL, поэтому декодирование идет параллельно с детекцией
+            next_name = next(names, None)
+            if next_name is not None:
+                pending.append((next_name, executor.submit(read, next_name)))
+            if metrics.enabled:
+                # Сколько изображений уже декодировано и ждет детектора
+                metrics.gauge('decoded_ready', sum(f.done() for _, f in pending))
+            with metrics.stage('decode_wait'):
+                image = future.result()
+            yield img_name, image
+
+
+def group_by_tiles(decoded, min_tiles, num_tiles):
+    """
+    Group decoded (img_name, image) pairs so that each group gives at least
+    min_tiles detector inputs, where num_tiles(height, width) counts the
+    inputs of one image. Unreadable images count as zero.
+    """
+    group, tiles = [], 0
+    for img_name, image in decoded:
+        group.append((img_name, image))
+        if image is not None:
+            tiles += num_tiles(*image.shape[:2])
+        if tiles >= min_tiles:
+            yield group
+            group, tiles = [], 0
+    if group:
+        yield group
+
+
+def transfer_image(src_path, dst_path):
+    """
+    Put the original file at dst_path without re-encoding: a hardlink when
+    both paths are on one filesystem, otherwise a byte copy.
+    """
+    tmp_path = tmp_path_for(dst_path)
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src_path, tmp_path)
+    except OSError:
+        shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, dst_path)
+
+
 # Обход всех изображений
 def run_detection(
     model_path,
@@ -33,64 +206,103 @@ def run_detection(
     overlap_ratio,
     device,
     object_class_id,
-    output_class_id
+    output_class_id,
+    writer_kwargs=None,
+    batched_slicing=False,
+    detector_batch_size=16,
+    num_decode_workers=4,
+    prefetch=16,
+    metrics=None
 ):
     # Создаем выходные папки
     os.makedirs(label_out_dir, exist_ok=True)
     os.makedirs(image_out_dir, exist_ok=True)
+    writer_kwargs = writer_kwargs or {}
+    metrics = metrics or NULL_METRICS
 
-    # Инициализация SAHI-модели
-    n_model = AutoDetectionModel.from_pretrained(
-        model_type='yolov8',
-        model_path=model_path,
-        confidence_threshold=conf_threshold,
-        device=device
-    )
+    with metrics.stage('load_model'):
+        if batched_slicing:
+            # Слайсы нескольких изображений собираются в батчи фиксированного размера
+            detector = BatchedSlicedDetector(
+                model_path, conf_threshold, device, slice_size, overlap_ratio, object_class_id,
+                batch_size=detector_batch_size
+            )
+            # Группа — столько изображений, сколько нужно, чтобы их слайсы заполнили один батч детектора:
+            # в памяти одновременно около batch_size слайсов, а не batch_size целых изображений
+            min_tiles, num_tiles = detector_batch_size, detector.num_tiles
+        else:
+            n_model = load_detection_model(model_path, conf_threshold, device)
+            min_tiles, num_tiles = 1, lambda height, width: 1
 
-    for img_name in tqdm(os.listdir(image_dir)):
-        if not img_name.lower().endswith(('.jpg', '.jpeg', '.png')):
-            continue
-        img_path = os.path.join(image_dir, img_name)
-        image = cv2.imread(img_path)
-        if image is None:
-            print(f"[WARN] Не удалось загрузить {img_path}")
-            continue
-        h, w = image.shape[:2]
-
-        # Слайсинг-инференс
-        result = get_sliced_prediction(
-            image,
-            n_model,
-            slice_height=slice_size,
-            slice_width=slice_size,
-            overlap_height_ratio=overlap_ratio,
-            overlap_width_ratio=overlap_ratio
-        )
+    # Пропускаем изображения, уже размеченные или отбракованные в прошлых запусках
+    progress = load_progress(label_out_dir)
+    img_names = [
+        img_name for img_name in os.listdir(image_dir)
+        if img_name.lower().endswith(('.jpg', '.jpeg', '.png', '.webp')) and img_name not in progress
+    ]
+    if progress:
+        print(f"[INFO] Пропущено {len(progress)} уже обработанных изображений")
 
-        # Сборка аннотаций
-        annotations = []
-        for obj in result.object_prediction_list:
-            if obj.category.id != object_class_id:
-                continue
-            xmin, ymin = obj.bbox.minx, obj.bbox.miny
-            xmax, ymax = obj.bbox.maxx, obj.bbox.maxy
-            x_center = ((xmin + xmax) / 2) / w
-            y_center = ((ymin + ymax) / 2) / h
-            width    = (xmax - xmin) / w
-            height   = (ymax - ymin) / h
-            annotations.append((output_class_id, x_center, y_center, width, height))
-
-        # Запись разметки и сохранение картинки
-        if annotations:
-            # сохраняем текстовый файл разметки
-            txt_path = os.path.join(label_out_dir, os.path.splitext(img_name)[0] + '.txt')
-            with open(txt_path, 'w') as f:
-                for cid, xc, yc, bw, bh in annotations:
-                    f.write(f"{cid} {xc:.6f} {yc:.6f} {bw:.6f} {bh:.6f}\n")
-            # сохраняем изображение в выходную папку
-            out_path = os.path.join(image_out_dir, img_name)
-            cv2.imwrite(out_path, image)
-            # print(f"[INFO] {img_name}: сохранено изображение и {len(annotations)} аннотаций")
+    # Без смены формата и параметров сжатия исходный файл переносится как есть (hardlink или копия байтов);
+    # иначе картинка перекодируется в фоновом пуле (без --image_format - в формате исходного файла)
+    writer = ImageWriter(metrics=metrics, **writer_kwargs) if reencodes(writer_kwargs) else None
+
+    with ProgressLog(label_out_dir) as progress_log, tqdm(total=len(img_names)) as pbar:
+        decoded = prefetch_images(image_dir, img_names, num_decode_workers, prefetch, metrics)
+        try:
+            for step, group in enumerate(group_by_tiles(decoded, min_tiles, num_tiles)):
+                pbar.update(len(group))
+                names, images = [], []
+                for img_name, image in group:
+                    if image is None:
+                        print(f"[WARN] Не удалось загрузить {os.path.join(image_dir, img_name)}")
+                        metrics.count('decode_failed')
+                        continue
+                    names.append(img_name)
+                    images.append(image)
+
+                with metrics.profile(step):
+                    if batched_slicing:
+                        with metrics.stage('detect_batch', names[0] if names else None):
+                            batch_annotations = detector.detect_annotations(images, output_class_id)
+                    else:
+                        batch_annotations = []
+                        for img_name, image in zip(names, images):
+                            with metrics.stage('detect', img_name):
+                                batch_annotations.append(detect_objects(
+                                    image, n_model, slice_size, overlap_ratio, object_class_id, output_class_id
+                                ))
+                metrics.sample_memory()
+
+                # Запись разметки и сохранение картинки
+                for img_name, image, annotations in zip(names, images, batch_annotations):
+                    if not annotations:
+                        # Ни одного бокса выше conf_threshold
+                        progress_log.mark(img_name, 'rejected')
+                        metrics.count('rejected')
+                        continue
+                    metrics.count('accepted')
+                    metrics.count('boxes', len(annotations))
+                    # сохраняем текстовый файл разметки
+                    txt_path = os.path.join(label_out_dir, os.path.splitext(img_name)[0] + '.txt')
+                    with metrics.stage('write_labels', img_name):
+                        write_labels(txt_path, annotations)
+                    # сохраняем изображение в выходную папку
+                    out_path = os.path.join(image_out_dir, img_name)
+                    if writer is None:
+                        with metrics.stage('transfer', img_name):
+                            transfer_image(os.path.join(image_dir, img_name), out_path)
+                        progress_log.mark(img_name, 'labeled')
+                    else:
+                        writer.submit(
+                            image, out_path,
+                            on_written=lambda path, name=img_name: progress_log.mark(name, 'labeled')
+                        )
+                    # print(f"[INFO] {img_name}: сохранено изображение и {len(annotations)} аннотаций")
+        finally:
+            decoded.close()
+            if writer is not None:
+                writer.close()
 
     print("Генерация разметки и сохранение изображений завершены")
 
@@ -107,17 +319,35 @@ if __name__ == '__main__':
     parser.add_argument('--device', type=str, default='cuda:0', help='Torch device for inference')
     parser.add_argument('--object_class_id', type=int, default=14, help='14 is original bird class ID in YOLO')
     parser.add_argument('--output_class_id', type=int, default=0, help='Class ID to write in output labels')
+    parser.add_argument('--batched_slicing', action='store_true',
+                        help='Use the batched sliced-inference engine instead of per-image SAHI calls')
+    parser.add_argument('--detector_batch_size', type=int, default=16,
+                        help='Number of slices per detector batch with --batched_slicing; images are '
+                             'grouped until their slices fill one batch')
+    parser.add_argument('--num_decode_workers', type=int, default=4,
+                        help='Number of threads decoding images ahead of detection')
+    parser.add_argument('--prefetch', type=int, default=16,
+                        help='Maximum number of decoded images waiting for detection')
+    add_writer_args(parser)
+    add_metrics_args(parser)
     args = parser.parse_args()
 
-    run_detection(
-        model_path=args.model_path,
-        image_dir=args.image_dir,
-        label_out_dir=args.label_out_dir,
-        image_out_dir=args.image_out_dir,
-        conf_threshold=args.conf_threshold,
-        slice_size=args.slice_size,
-        overlap_ratio=args.overlap_ratio,
-        device=args.device,
-        object_class_id=args.object_class_id,
-        output_class_id=args.output_class_id
-    )
+    with metrics_from_args(args) as metrics:
+        run_detection(
+            model_path=args.model_path,
+            image_dir=args.image_dir,
+            label_out_dir=args.label_out_dir,
+            image_out_dir=args.image_out_dir,
+            conf_threshold=args.conf_threshold,
+            slice_size=args.slice_size,
+            overlap_ratio=args.overlap_ratio,
+            device=args.device,
+            object_class_id=args.object_class_id,
+            output_class_id=args.output_class_id,
+            writer_kwargs=writer_kwargs_from_args(args),
+            batched_slicing=args.batched_slicing,
+            detector_batch_size=args.detector_batch_size,
+            num_decode_workers=args.num_decode_workers,
+            prefetch=args.prefetch,
+            metrics=metrics
+        )
@@ -0,0 +1,750 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2025 Kirill Lekanov. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import shutil
+import platform
+import resource
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+
+import numpy as np
+
+from instrumentation import Metrics, latency_stats, peak_rss_mb
+
+# Тяжелые библиотеки импортируются внутри функций: каждый этап запускается в отдельном
+# spawn-процессе, и peak RSS этапа не должен включать модули других этапов
+# generation — UNet из объединенного снапшота (--fused_unet_dir), generation_lora — базовый UNet и LoRA
+# через load_attn_procs (--lora_checkpoint_dir) с необъединенными адаптерами на каждом шаге
+STAGES = ('crop', 'generation', 'generation_lora', 'labeling')
+
+
+def git_commit():
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=repo_dir, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+        dirty = bool(subprocess.check_output(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_dir,
+            stderr=subprocess.DEVNULL, text=True
+        ).strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def make_synthetic_dataset(root, num_images, image_width, image_height, boxes_per_image,
+                           min_box_size, max_box_size, seed=0):
+    """
+    Write num_images JPEG images with YOLO labels (class 0) into
+    root/images and root/labels. Images are smooth random backgrounds with
+    boxes_per_image bright rectangles, one per label line.
+    """
+    import cv2
+
+    images_dir = os.path.join(root, 'images')
+    labels_dir = os.path.join(root, 'labels')
+    os.makedirs(images_dir, exist_ok=True)
+    os.makedirs(labels_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for i in range(num_images):
+        # Низкочастотный шум сжимается в JPEG примерно как фотография, в отличие от белого шума
+        small = rng.integers(0, 256, (max(image_height // 32, 1), max(image_width // 32, 1), 3), dtype=np.uint8)
+        image = cv2.resize(small, (image_width, image_height), interpolation=cv2.INTER_CUBIC)
+        lines = []
+        for _ in range(boxes_per_image):
+            bw, bh = rng.integers(min_box_size, max_box_size + 1, 2)
+            x = int(rng.integers(0, image_width - bw + 1))
+            y = int(rng.integers(0, image_height - bh + 1))
+            cv2.rectangle(image, (x, y), (x + bw - 1, y + bh - 1), (235, 235, 235), thickness=-1)
+            lines.append(
+                f"0 {(x + bw / 2) / image_width:.6f} {(y + bh / 2) / image_height:.6f} "
+                f"{bw / image_width:.6f} {bh / image_height:.6f}\n"
+            )
+        cv2.imwrite(os.path.join(images_dir, f"synthetic_{i:05d}.jpg"), image)
+        with open(os.path.join(labels_dir, f"synthetic_{i:05d}.txt"), 'w') as f:
+            f.writelines(lines)
+    return images_dir, labels_dir
+
+
+def tiny_tokenizer(tokenizer_dir):
+    """
+    CLIP tokenizer without BPE merges: every byte is its own token. Enough
+    for the text encoder stand-in and needs no download.
+    """
+    from transformers import CLIPTokenizer
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+    chars = list(bytes_to_unicode().values())
+    tokens = chars + [c + '</w>' for c in chars] + ['<|startoftext|>', '<|endoftext|>']
+    vocab_file = os.path.join(tokenizer_dir, 'vocab.json')
+    merges_file = os.path.join(tokenizer_dir, 'merges.txt')
+    with open(vocab_file, 'w') as f:
+        json.dump({token: i for i, token in enumerate(tokens)}, f)
+    with open(merges_file, 'w') as f:
+        f.write('#version: 0.2\n')
+    return CLIPTokenizer(vocab_file, merges_file, model_max_length=77)
+
+
+def build_tiny_pipeline(pipeline_dir, resolution=64, seed=0):
+    """
+    Save a randomly initialised Stable Diffusion pipeline with the same
+    layout as the real one but a few MB of weights. It generates
+    resolution x resolution images.
+    """
+    import torch
+    from diffusers import AutoencoderKL, DDIMScheduler, StableDiffusionPipeline, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel
+
+    torch.manual_seed(seed)
+    with tempfile.TemporaryDirectory() as tokenizer_dir:
+        tokenizer = tiny_tokenizer(tokenizer_dir)
+    # Два уровня VAE: латенты в 2 раза меньше картинки
+    vae = AutoencoderKL(
+        in_channels=3,
+        out_channels=3,
+        down_block_types=('DownEncoderBlock2D', 'DownEncoderBlock2D'),
+        up_block_types=('UpDecoderBlock2D', 'UpDecoderBlock2D'),
+        block_out_channels=(32, 64),
+        latent_channels=4,
+        sample_size=resolution,
+    )
+    unet = UNet2DConditionModel(
+        sample_size=resolution // 2,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=('DownBlock2D', 'CrossAttnDownBlock2D'),
+        up_block_types=('CrossAttnUpBlock2D', 'UpBlock2D'),
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        cross_attention_dim=32,
+    )
+    eos_token_id = len(tokenizer.encoder) - 1
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        vocab_size=len(tokenizer.encoder),
+        hidden_size=32,
+        intermediate_size=37,
+        num_attention_heads=4,
+        num_hidden_layers=2,
+        max_position_embeddings=77,
+        bos_token_id=eos_token_id - 1,
+        eos_token_id=eos_token_id,
+        pad_token_id=eos_token_id,
+    ))
+    scheduler = DDIMScheduler(
+        beta_start=0.00085, beta_end=0.012, beta_schedule='scaled_linear',
+        clip_sample=False, set_alpha_to_one=False,
+    )
+    pipe = StableDiffusionPipeline(
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        unet=unet,
+        scheduler=scheduler,
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+    )
+    pipe.save_pretrained(pipeline_dir)
+    return pipeline_dir
+
+
+def build_tiny_lora(pipeline_dir, lora_dir, rank=4, seed=0):
+    """
+    Attach a LoRA with random weights to the UNet of the tiny pipeline the
+    same way the training script does and save it in the format that
+    --lora_checkpoint_dir expects.
+    """
+    import torch
+    from diffusers import StableDiffusionPipeline, UNet2DConditionModel
+    from diffusers.utils import convert_state_dict_to_diffusers
+    from peft import LoraConfig
+    from peft.utils import get_peft_model_state_dict
+
+    torch.manual_seed(seed)
+    unet = UNet2DConditionModel.from_pretrained(pipeline_dir, subfolder='unet')
+    unet.add_adapter(LoraConfig(
+        r=rank, lora_alpha=rank, init_lora_weights='gaussian', target_modules=['to_k', 'to_q', 'to_v', 'to_out.0'],
+    ))
+    # После инициализации lora_B нулевые, и адаптер ничего бы не менял: заполняем их случайно
+    with torch.no_grad():
+        for name, param in unet.named_parameters():
+            if 'lora_B' in name:
+                param.normal_(std=0.02)
+    StableDiffusionPipeline.save_lora_weights(
+        save_directory=lora_dir,
+        unet_lora_layers=convert_state_dict_to_diffusers(get_peft_model_state_dict(unet)),
+        safe_serialization=True,
+    )
+    return lora_dir
+
+
+def build_tiny_detector(model_path, object_class_id=14, class_bias=None, seed=0):
+    """
+    Save a randomly initialised YOLOv8n as a checkpoint that YOLO() and SAHI
+    load like trained weights. With the default head initialisation nothing
+    passes a usual confidence threshold, so every image is rejected;
+    class_bias sets the logit bias of object_class_id to make the detector
+    fire and exercise the label/image write path.
+    """
+    import torch
+    from ultralytics import YOLO
+
+    torch.manual_seed(seed)
+    model = YOLO('yolov8n.yaml').model
+    if class_bias is not None:
+        head = model.model[-1]
+        for branch in head.cv3:
+            branch[-1].bias.data[object_class_id] = class_bias
+    torch.save({'model': model, 'train_args': {}}, model_path)
+    return model_path
+
+
+def run_crop_stage(config, output_dir, metrics=None):
+    from prepare_dataset_for_finetuning import transfer_and_crop_good_birds
+
+    transfer_and_crop_good_birds(
+        images_dir=config['images_dir'],
+        labels_dir=config['labels_dir'],
+        output_dir=output_dir,
+        crop_size=config['crop_size'],
+        percent=config['percent'],
+        stride=config['stride'],
+        num_workers=config['num_workers'],
+        output_format=config['output_format'],
+        metrics=metrics,
+    )
+    return config['num_images']
+
+
+def run_generation_stage(config, output_dir, metrics=None, fused=True):
+    from sd_sampling_after_finetuning_lora import run_inference
+
+    # fused: снапшот из export_fused_lora.py; иначе базовый UNet и LoRA подгружаются при каждом запуске
+    run_inference(
+        pretrained_model_name_or_path=config['pipeline_dir'],
+        lora_checkpoint_dir=None if fused else config['lora_dir'],
+        output_dir=output_dir,
+        prompt=config['prompt'],
+        device=config['device'],
+        num_inference_steps=config['num_inference_steps'],
+        guidance_scale=config['guidance_scale'],
+        num_images=config['num_generated_images'],
+        batch_size=config['batch_size'],
+        fused_unet_dir=config['fused_unet_dir'] if fused else None,
+        metrics=metrics,
+    )
+    return config['num_generated_images']
+
+
+def run_lora_generation_stage(config, output_dir, metrics=None):
+    return run_generation_stage(config, output_dir, metrics, fused=False)
+
+
+def run_labeling_stage(config, output_dir, metrics=None):
+    from auto_labeling_with_img_transfer import run_detection
+
+    label_out_dir = os.path.join(output_dir, 'labels')
+    run_detection(
+        model_path=config['detector_path'],
+        image_dir=config['images_dir'],
+        label_out_dir=label_out_dir,
+        image_out_dir=os.path.join(output_dir, 'images'),
+        conf_threshold=config['conf_threshold'],
+        slice_size=config['slice_size'],
+        overlap_ratio=config['overlap_ratio'],
+        device=config['device'],
+        object_class_id=config['object_class_id'],
+        output_class_id=0,
+        batched_slicing=config['batched_slicing'],
+        detector_batch_size=config['detector_batch_size'],
+        metrics=metrics,
+    )
+    return config['num_images']
+
+
+def read_label_file(path):
+    with open(path, 'r') as f:
+        return np.array([[float(v) for v in line.split()] for line in f if line.strip()]).reshape(-1, 5)
+
+
+def compare_label_dirs(reference_dir, candidate_dir, atol=1e-3):
+    """
+    Compare two directories of YOLO label files: the same images must be
+    accepted, with the same number of boxes, and every reference box must
+    match a distinct candidate box of the same class within atol.
+    """
+    reference = sorted(name for name in os.listdir(reference_dir) if name.endswith('.txt'))
+    candidate = sorted(name for name in os.listdir(candidate_dir) if name.endswith('.txt'))
+    mismatched = sorted(set(reference) ^ set(candidate))
+    max_diff = 0.0
+    for name in sorted(set(reference) & set(candidate)):
+        ref_boxes = read_label_file(os.path.join(reference_dir, name))
+        cand_boxes = read_label_file(os.path.join(candidate_dir, name))
+        if len(ref_boxes) != len(cand_boxes):
+            mismatched.append(name)
+            continue
+        unused = list(range(len(cand_boxes)))
+        for box in ref_boxes:
+            # Порядок боксов в файле не важен: ищем ближайший еще не сопоставленный бокс
+            diffs = [
+                np.abs(cand_boxes[j, 1:] - box[1:]).max() if cand_boxes[j, 0] == box[0] else np.inf
+                for j in unused
+            ]
+            best = int(np.argmin(diffs))
+            max_diff = max(max_diff, float(diffs[best]))
+            if diffs[best] > atol:
+                mismatched.append(name)
+                break
+            unused.pop(best)
+    return {
+        'reference_files': len(reference),
+        'candidate_files': len(candidate),
+        'mismatched': mismatched,
+        'max_abs_diff': max_diff,
+        'atol': atol,
+    }
+
+
+def check_labeling_parity(config, atol=1e-3):
+    """
+    Label the synthetic dataset with per-image SAHI calls and with the
+    batched sliced engine, and compare the label files.
+    """
+    outputs = {}
+    for mode, batched in (('sahi', False), ('batched', True)):
+        outputs[mode] = os.path.join(config['work_dir'], 'parity', mode)
+        run_labeling_stage(dict(config, batched_slicing=batched), outputs[mode])
+    return compare_label_dirs(
+        os.path.join(outputs['sahi'], 'labels'), os.path.join(outputs['batched'], 'labels'), atol
+    )
+
+
+class _CrashingPipeline:
+    """Pipeline wrapper that kills its process on the batch after crash_after_batches batches."""
+
+    def __init__(self, pipe, crash_after_batches):
+        self.pipe = pipe
+        self.crash_after_batches = crash_after_batches
+        self.batches = 0
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+    def __call__(self, *args, **kwargs):
+        if self.batches >= self.crash_after_batches:
+            # Жесткое падение посреди чанка: без finally, блокировка снимается только ОС
+            os._exit(1)
+        self.batches += 1
+        return self.pipe(*args, **kwargs)
+
+
+def crashing_pipeline_loader(pretrained_model_name_or_path, lora_checkpoint_dir, device,
+                             crash_marker, crash_after_batches, **kwargs):
+    """load_pipeline for sharded workers where the first worker to create crash_marker crashes mid-chunk."""
+    from sd_sampling_after_finetuning_lora import load_pipeline
+
+    pipe = load_pipeline(pretrained_model_name_or_path, lora_checkpoint_dir, device, **kwargs)
+    try:
+        fd = os.open(crash_marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return pipe
+    os.close(fd)
+    return _CrashingPipeline(pipe, crash_after_batches)
+
+
+def read_image_array(path):
+    from PIL import Image
+
+    with Image.open(path) as image:
+        return np.asarray(image.convert('RGB'), dtype=np.int16)
+
+
+def check_sharded_generation(config, num_images, num_workers, chunk_size, pixel_atol=2):
+    """
+    Generate num_images with sharded_sampling.py workers on the tiny pipeline
+    while one worker crashes in the middle of its first chunk, rerun, and
+    check that the rerun regenerates only the missing indices and that every
+    image matches a batch_size=1 run of sd_sampling_after_finetuning_lora.py.
+    """
+    from functools import partial
+    from sharded_sampling import run_sharded_inference
+    from sd_sampling_after_finetuning_lora import run_inference, missing_indices, image_path
+
+    root = os.path.join(config['work_dir'], 'sharded')
+    # Маркер падения и готовые картинки прошлого запуска с --work_dir сломали бы проверку
+    shutil.rmtree(root, ignore_errors=True)
+    reference_dir = os.path.join(root, 'reference')
+    output_dir = os.path.join(root, 'output')
+    generation_kwargs = {
+        'pretrained_model_name_or_path': config['pipeline_dir'],
+        'lora_checkpoint_dir': None,
+        'prompt': config['prompt'],
+        'num_inference_steps': config['num_inference_steps'],
+        'guidance_scale': config['guidance_scale'],
+        'num_images': num_images,
+        'fused_unet_dir': config['fused_unet_dir'],
+    }
+    run_inference(output_dir=reference_dir, device=config['device'], batch_size=1, **generation_kwargs)
+
+    crash_loader = partial(
+        crashing_pipeline_loader,
+        crash_marker=os.path.join(root, 'crash.marker'),
+        # Первый батч чанка записывается, падение приходится на второй
+        crash_after_batches=1,
+    )
+    sharded_kwargs = dict(
+        generation_kwargs, output_dir=output_dir, devices=[config['device']], batch_size=config['batch_size'],
+        chunk_size=chunk_size, workers_per_device=num_workers,
+    )
+    try:
+        run_sharded_inference(pipeline_loader=crash_loader, **sharded_kwargs)
+    except RuntimeError as e:
+        print(f"[INFO] Ожидаемое падение воркера: {e}")
+    else:
+        raise AssertionError('The crashing worker did not fail')
+
+    missing = missing_indices(output_dir, range(num_images))
+    # os.replace создает новый inode: по нему видно, какие файлы перезаписаны при повторном запуске
+    inodes = {i: os.stat(image_path(output_dir, i)).st_ino for i in sorted(set(range(num_images)) - set(missing))}
+    run_sharded_inference(**sharded_kwargs)
+
+    still_missing = missing_indices(output_dir, range(num_images))
+    written = sorted(set(range(num_images)) - set(still_missing))
+    regenerated = [i for i in written if os.stat(image_path(output_dir, i)).st_ino != inodes.get(i)]
+    leftovers = [name for name in os.listdir(output_dir) if name.endswith('.tmp')]
+    max_diff = 0
+    different = []
+    for i in written:
+        diff = int(np.abs(
+            read_image_array(image_path(output_dir, i)) - read_image_array(image_path(reference_dir, i))
+        ).max())
+        max_diff = max(max_diff, diff)
+        if diff > pixel_atol:
+            different.append(i)
+    return {
+        'num_images': num_images,
+        'num_workers': num_workers,
+        'chunk_size': chunk_size,
+        'missing_after_crash': missing,
+        'regenerated': regenerated,
+        'still_missing': still_missing,
+        'tmp_files_left': leftovers,
+        'different_from_batch_size_1': different,
+        'max_pixel_diff': max_diff,
+        'pixel_atol': pixel_atol,
+        'ok': regenerated == missing and not still_missing and not leftovers and not different,
+    }
+
+
+STAGE_FUNCTIONS = {
+    'crop': run_crop_stage,
+    'generation': run_generation_stage,
+    'generation_lora': run_lora_generation_stage,
+    'labeling': run_labeling_stage,
+}
+
+
+# Загрузка моделей не входит в пропускную способность и отчитывается отдельно
+LOAD_STAGES = ('load_pipeline', 'load_model')
+
+
+def _stage_process(stage, config, repeats, warmup, conn):
+    """Body of the spawned process of one stage; sends the measurements back over conn."""
+    try:
+        run_stage = STAGE_FUNCTIONS[stage]
+        wall_times = []
+        load_times = []
+        durations = {}
+        items = 0
+        for repeat in range(warmup + repeats):
+            # Каждый повтор пишет в новую папку, иначе возобновление пропустит уже готовые файлы
+            output_dir = os.path.join(config['work_dir'], 'runs', f"{stage}_{repeat}")
+            metrics = Metrics(os.path.join(config['work_dir'], 'runs', f"{stage}_{repeat}.metrics.jsonl"))
+            start = time.perf_counter()
+            items = run_stage(config, output_dir, metrics)
+            elapsed = time.perf_counter() - start
+            run_durations = metrics.durations()
+            metrics.close(quiet=True)
+            if repeat >= warmup:
+                wall_times.append(elapsed)
+                load_times.append(sum(sum(run_durations.get(name, ())) for name in LOAD_STAGES))
+                for name, values in run_durations.items():
+                    durations.setdefault(name, []).extend(values)
+            last_output_dir = output_dir
+        result = {
+            'items': items,
+            'wall_s': wall_times,
+            'load_s': load_times,
+            'durations_s': durations,
+            # Дочерние процессы (пул кропа) учитываются отдельно от самого процесса этапа
+            'peak_rss_mb': max(peak_rss_mb(resource.RUSAGE_SELF), peak_rss_mb(resource.RUSAGE_CHILDREN)),
+        }
+        if stage == 'labeling':
+            labels = os.listdir(os.path.join(last_output_dir, 'labels'))
+            result['accepted'] = sum(name.endswith('.txt') for name in labels)
+        conn.send(('ok', result))
+    except BaseException as e:
+        conn.send(('error', f"{type(e).__name__}: {e}"))
+        raise
+    finally:
+        conn.close()
+
+
+def measure_stage(stage, config, repeats, warmup):
+    """
+    Run one stage warmup + repeats times in a fresh spawned process. Returns
+    throughput without model loading, model load time, per-item latency
+    percentiles of every internal step (decode, detect, generate, encode,
+    write, ...) pooled over the measured repeats, and peak RSS.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_stage_process, args=(stage, config, repeats, warmup, child_conn))
+    process.start()
+    child_conn.close()
+    try:
+        status, payload = parent_conn.recv()
+    except EOFError:
+        status, payload = 'error', f"process exited with code {process.exitcode}"
+    process.join()
+    if status != 'ok':
+        raise RuntimeError(f"Stage {stage} failed: {payload}")
+
+    wall = np.array(payload['wall_s'])
+    load = np.array(payload['load_s'])
+    items = payload['items']
+    result = {
+        'items': items,
+        'repeats': len(wall),
+        'images_per_sec': items / float(np.median(wall - load)),
+        'model_load_s': float(load.mean()),
+        'wall_s': float(np.median(wall)),
+        'steps': {
+            name: latency_stats(values)
+            for name, values in payload['durations_s'].items()
+            if name not in LOAD_STAGES
+        },
+        'peak_rss_mb': payload['peak_rss_mb'],
+    }
+    if 'accepted' in payload:
+        result['accepted'] = payload['accepted']
+    return result
+
+
+def compare_results(current, baseline_path):
+    """Print throughput and peak RSS changes against a previous result file."""
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    print(f"Сравнение с {baseline_path} (commit {baseline.get('commit')}):")
+    for stage, result in current['stages'].items():
+        base = baseline.get('stages', {}).get(stage)
+        if base is None:
+            print(f"  {stage}: нет в базовом результате")
+            continue
+        speedup = result['images_per_sec'] / base['images_per_sec']
+        rss_change = result['peak_rss_mb'] - base['peak_rss_mb']
+        print(
+            f"  {stage}: {base['images_per_sec']:.2f} -> {result['images_per_sec']:.2f} img/s "
+            f"(x{speedup:.2f}), peak RSS {base['peak_rss_mb']:.0f} -> {result['peak_rss_mb']:.0f} MB "
+            f"({rss_change:+.0f} MB)"
+        )
+        if 'model_load_s' in result and 'model_load_s' in base:
+            print(f"  {stage}: загрузка моделей {base['model_load_s']:.2f} -> {result['model_load_s']:.2f} s")
+
+
+def run_benchmark(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='augmentation_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        images_dir, labels_dir = make_synthetic_dataset(
+            os.path.join(work_dir, 'dataset'), args.num_images, args.image_width, args.image_height,
+            args.boxes_per_image, args.min_box_size, args.max_box_size, seed=args.seed,
+        )
+        config = {
+            'work_dir': work_dir,
+            'images_dir': images_dir,
+            'labels_dir': labels_dir,
+            'num_images': args.num_images,
+            'crop_size': args.crop_size,
+            'percent': args.percent,
+            'stride': args.stride or args.crop_size,
+            'num_workers': args.num_workers,
+            'output_format': args.output_format,
+            'device': args.device,
+            'prompt': 'flying bird',
+            'num_generated_images': args.num_generated_images,
+            'num_inference_steps': args.num_inference_steps,
+            'guidance_scale': args.guidance_scale,
+            'batch_size': args.batch_size,
+            'conf_threshold': args.conf_threshold,
+            'slice_size': args.slice_size,
+            'overlap_ratio': args.overlap_ratio,
+            'object_class_id': 14,
+            'batched_slicing': args.batched_slicing,
+            'detector_batch_size': args.detector_batch_size,
+        }
+        if {'generation', 'generation_lora'} & set(args.stages) or args.check_sharded_generation:
+            from export_fused_lora import export_fused_unet
+
+            config['pipeline_dir'] = build_tiny_pipeline(
+                os.path.join(work_dir, 'tiny_sd'), args.generation_resolution, seed=args.seed
+            )
+            config['lora_dir'] = build_tiny_lora(
+                config['pipeline_dir'], os.path.join(work_dir, 'tiny_lora'), seed=args.seed
+            )
+            # Снапшот строится тем же export_fused_lora.py, что и для настоящей модели
+            config['fused_unet_dir'] = os.path.join(work_dir, 'tiny_fused_unet')
+            export_fused_unet(config['pipeline_dir'], config['lora_dir'], config['fused_unet_dir'], device=args.device)
+        if 'labeling' in args.stages or args.check_labeling_parity:
+            config['detector_path'] = build_tiny_detector(
+                os.path.join(work_dir, 'tiny_yolov8n.pt'), config['object_class_id'],
+                args.detector_class_bias, seed=args.seed,
+            )
+
+        commit, dirty = git_commit()
+        results = {
+            'commit': commit,
+            'dirty': dirty,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'work_dir')},
+            'stages': {},
+        }
+        for stage in args.stages:
+            print(f"[INFO] Этап {stage}: {args.warmup} прогрев + {args.repeats} замеров")
+            results['stages'][stage] = result = measure_stage(stage, config, args.repeats, args.warmup)
+            print(
+                f"[INFO] {stage}: {result['images_per_sec']:.2f} img/s без загрузки моделей, "
+                f"загрузка {result['model_load_s']:.2f} s, peak RSS {result['peak_rss_mb']:.0f} MB"
+            )
+            for name, stats in sorted(result['steps'].items()):
+                print(
+                    f"[INFO]   {name:>20}: n={stats['count']:<6} p50 {stats['p50_s'] * 1000:8.1f} ms  "
+                    f"p90 {stats['p90_s'] * 1000:8.1f} ms  p99 {stats['p99_s'] * 1000:8.1f} ms"
+                )
+        if args.check_labeling_parity:
+            results['labeling_parity'] = parity = check_labeling_parity(config, args.parity_atol)
+            print(
+                f"[INFO] Разметка SAHI и --batched_slicing: {parity['reference_files']} / "
+                f"{parity['candidate_files']} файлов, расхождений {len(parity['mismatched'])}, "
+                f"max diff {parity['max_abs_diff']:.2e}"
+            )
+        if args.check_sharded_generation:
+            results['sharded_generation'] = sharded = check_sharded_generation(
+                config, args.sharded_num_images, args.sharded_workers, args.sharded_chunk_size,
+                args.sharded_pixel_atol,
+            )
+            print(
+                f"[INFO] Шардированная генерация: после падения не хватало {len(sharded['missing_after_crash'])} "
+                f"изображений, перезапуск сгенерировал {len(sharded['regenerated'])}, "
+                f"отличий от batch_size=1 {len(sharded['different_from_batch_size_1'])}, "
+                f"max diff {sharded['max_pixel_diff']}"
+            )
+    finally:
+        if not args.keep_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print("Результаты сохранены:", args.output)
+    if args.compare:
+        compare_results(results, args.compare)
+    if 'sharded_generation' in results and not results['sharded_generation']['ok']:
+        raise SystemExit(f"Sharded generation check failed: {results['sharded_generation']}")
+    if results.get('labeling_parity', {}).get('mismatched'):
+        raise SystemExit(f"Labels differ between SAHI and --batched_slicing: {results['labeling_parity']['mismatched']}")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Offline CPU benchmark of crop preparation, generation and auto-labeling '
+                    'on synthetic data with tiny randomly initialised models'
+    )
+    parser.add_argument('--stages', type=str, nargs='+', default=list(STAGES), choices=STAGES,
+                        help='Stages to benchmark')
+    parser.add_argument('--output', type=str, default='benchmark_results.json', help='Where to write the JSON results')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Previous results JSON to compare throughput and peak RSS with')
+    parser.add_argument('--work_dir', type=str, default=None,
+                        help='Directory for synthetic data and models (a temporary directory by default)')
+    parser.add_argument('--keep_work_dir', action='store_true', help='Do not delete the work directory at exit')
+    parser.add_argument('--repeats', type=int, default=3, help='Measured runs per stage')
+    parser.add_argument('--warmup', type=int, default=1, help='Unmeasured runs per stage before the measured ones')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic dataset and model weights')
+    parser.add_argument('--device', type=str, default='cpu', help='Torch device for generation and labeling')
+    # Синтетический датасет
+    parser.add_argument('--num_images', type=int, default=32, help='Number of synthetic dataset images')
+    parser.add_argument('--image_width', type=int, default=1920, help='Width of synthetic images')
+    parser.add_argument('--image_height', type=int, default=1080, help='Height of synthetic images')
+    parser.add_argument('--boxes_per_image', type=int, default=4, help='Number of labeled boxes per image')
+    parser.add_argument('--min_box_size', type=int, default=40, help='Minimum box side in pixels')
+    parser.add_argument('--max_box_size', type=int, default=160, help='Maximum box side in pixels')
+    # Кроп
+    parser.add_argument('--crop_size', type=int, default=512, help='Crop window size')
+    parser.add_argument('--percent', type=float, default=0.015, help='Minimum normalized size of a good bird')
+    parser.add_argument('--stride', type=int, default=None, help='Crop window stride (crop_size if not set)')
+    parser.add_argument('--num_workers', type=int, default=None, help='Crop worker processes')
+    parser.add_argument('--output_format', type=str, default='files', choices=['files', 'arrow'],
+                        help='Crop output format')
+    # Генерация
+    parser.add_argument('--num_generated_images', type=int, default=8, help='Images generated per run')
+    parser.add_argument('--generation_resolution', type=int, default=64, help='Side of generated images')
+    parser.add_argument('--num_inference_steps', type=int, default=10, help='Number of inference steps')
+    parser.add_argument('--guidance_scale', type=float, default=7.5, help='Guidance scale')
+    parser.add_argument('--batch_size', type=int, default=4, help='Generation batch size')
+    parser.add_argument('--check_sharded_generation', action='store_true',
+                        help='Also run sharded_sampling.py workers with one of them crashing mid-chunk, rerun, and '
+                             'check that only missing images are regenerated and all match a batch_size=1 run')
+    parser.add_argument('--sharded_num_images', type=int, default=32, help='Images generated in the sharded check')
+    parser.add_argument('--sharded_workers', type=int, default=3, help='Worker processes in the sharded check')
+    parser.add_argument('--sharded_chunk_size', type=int, default=8,
+                        help='Chunk size in the sharded check; must be larger than --batch_size')
+    parser.add_argument('--sharded_pixel_atol', type=int, default=2,
+                        help='Maximum per-pixel difference (0-255) from the batch_size=1 run in the sharded check')
+    # Разметка
+    parser.add_argument('--conf_threshold', type=float, default=0.7, help='Detection confidence threshold')
+    parser.add_argument('--slice_size', type=int, default=768, help='SAHI slice size')
+    parser.add_argument('--overlap_ratio', type=float, default=0.2, help='SAHI slice overlap ratio')
+    parser.add_argument('--batched_slicing', action='store_true', help='Use the batched sliced-inference engine')
+    parser.add_argument('--detector_batch_size', type=int, default=16, help='Slices per detector batch')
+    parser.add_argument('--detector_class_bias', type=float, default=None,
+                        help='Logit bias of the bird class in the random detector; set it (e.g. 2.0) '
+                             'to make the stand-in accept images and exercise the write path')
+    parser.add_argument('--check_labeling_parity', action='store_true',
+                        help='Also label the dataset with and without --batched_slicing and compare the label files; '
+                             'use with --detector_class_bias so that the detector finds boxes')
+    parser.add_argument('--parity_atol', type=float, default=1e-3,
+                        help='Maximum allowed difference of normalized box coordinates in the parity check')
+    args = parser.parse_args()
+    if args.repeats < 1:
+        parser.error('--repeats must be at least 1')
+    if args.check_sharded_generation and args.sharded_workers < 2:
+        # С одним воркером генерация идет в этом же процессе, и падение завершило бы сам бенчмарк
+        parser.error('--sharded_workers must be at least 2')
+    if args.check_sharded_generation and args.sharded_chunk_size <= args.batch_size:
+        # Иначе чанк генерируется одним батчем и воркер не может упасть посреди чанка
+        parser.error('--sharded_chunk_size must be larger than --batch_size')
+
+    run_benchmark(args)
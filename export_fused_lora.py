@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2025 Kirill Lekanov. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+
+import torch
+
+from sd_sampling_after_finetuning_lora import load_pipeline, load_fused_unet
+
+DTYPES = {
+    'float32': torch.float32,
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16,
+}
+
+
+@torch.no_grad()
+def unet_probe(unet, seed=0, timestep=500):
+    """
+    One UNet forward pass on fixed random inputs, used to compare the
+    fused snapshot with the unfused LoRA UNet.
+    """
+    generator = torch.Generator(device='cpu').manual_seed(seed)
+    config = unet.config
+    sample = torch.randn(
+        (1, config.in_channels, config.sample_size, config.sample_size), generator=generator
+    )
+    encoder_hidden_states = torch.randn((1, 77, config.cross_attention_dim), generator=generator)
+    return unet(
+        sample.to(unet.device, unet.dtype),
+        torch.tensor([timestep], device=unet.device),
+        encoder_hidden_states.to(unet.device, unet.dtype),
+        return_dict=False,
+    )[0].float().cpu()
+
+
+def export_fused_unet(
+    pretrained_model_name_or_path,
+    lora_checkpoint_dir,
+    output_dir,
+    device='cpu',
+    lora_scale=1.0,
+    dtype='float32',
+    verify=True,
+    atol=1e-3,
+):
+    """
+    Merge the LoRA weights into the UNet and save it as a single
+    safetensors file plus config.json in output_dir. With verify=True,
+    the saved snapshot is loaded back the way generation loads it and
+    compared with the unfused LoRA UNet on a fixed probe input.
+    """
+    # Тот же путь загрузки, что и при генерации без слияния
+    pipe = load_pipeline(pretrained_model_name_or_path, lora_checkpoint_dir, device)
+    reference = unet_probe(pipe.unet) if verify else None
+
+    pipe.fuse_lora(components=['unet'], lora_scale=lora_scale)
+    pipe.unload_lora_weights()
+    pipe.unet.to(DTYPES[dtype])
+    # Большой max_shard_size: снапшот всегда один файл
+    pipe.unet.save_pretrained(output_dir, safe_serialization=True, max_shard_size='100GB')
+    print("Сохранен UNet с объединенными весами LoRA:", output_dir)
+
+    if verify:
+        del pipe
+        unet = load_fused_unet(output_dir).to(device)
+        max_diff = (unet_probe(unet) - reference).abs().max().item()
+        print(f"Max abs difference to the unfused LoRA UNet: {max_diff:.3e} (atol {atol:.1e})")
+        if max_diff > atol:
+            raise RuntimeError(
+                f"Fused UNet differs from the unfused LoRA UNet by {max_diff:.3e} > {atol:.1e}"
+            )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge a LoRA checkpoint into the UNet and save a single snapshot')
+    parser.add_argument('--pretrained_model_name_or_path', type=str, default='stabilityai/stable-diffusion-2',
+                        help='Pretrained Stable Diffusion repo or path')
+    parser.add_argument('--lora_checkpoint_dir', type=str, required=True,
+                        help='Directory with LoRA attention processors')
+    parser.add_argument('--output_dir', type=str, required=True,
+                        help='Where to save the fused UNet snapshot')
+    parser.add_argument('--device', type=str, default='cpu',
+                        help='Torch device used for fusing and verification')
+    parser.add_argument('--lora_scale', type=float, default=1.0,
+                        help='Scale of the LoRA update merged into the weights')
+    parser.add_argument('--dtype', type=str, default='float32', choices=sorted(DTYPES),
+                        help='Dtype of the saved weights')
+    parser.add_argument('--no_verify', action='store_true',
+                        help='Skip the numerical comparison with the unfused LoRA UNet')
+    parser.add_argument('--atol', type=float, default=1e-3,
+                        help='Maximum allowed absolute difference of the UNet output')
+    args = parser.parse_args()
+
+    export_fused_unet(
+        pretrained_model_name_or_path=args.pretrained_model_name_or_path,
+        lora_checkpoint_dir=args.lora_checkpoint_dir,
+        output_dir=args.output_dir,
+        device=args.device,
+        lora_scale=args.lora_scale,
+        dtype=args.dtype,
+        verify=not args.no_verify,
+        atol=args.atol,
+    )
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2025 Kirill Lekanov. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import queue
+import argparse
+import threading
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+from sd_sampling_after_finetuning_lora import (
+    load_pipeline,
+    encode_prompt_once,
+    generate_batch,
+    add_unet_source_args,
+    check_unet_source_args,
+    add_generation_args,
+)
+from auto_labeling_with_img_transfer import (
+    load_detection_model,
+    detect_objects,
+    write_labels,
+    load_progress,
+    ProgressLog,
+)
+from image_writer import ImageWriter, EXTENSIONS, add_writer_args, writer_kwargs_from_args
+from instrumentation import NULL_METRICS, add_metrics_args, metrics_from_args
+
+# Маркер конца потока в очереди
+_DONE = object()
+
+
+def produce_images(
+    pipe,
+    indices,
+    image_queue,
+    stop_event,
+    prompt,
+    negative_prompt,
+    num_inference_steps,
+    guidance_scale,
+    batch_size,
+    seed,
+    metrics=NULL_METRICS,
+):
+    """Generate images batch by batch and put (index, BGR array) into image_queue."""
+    prompt_embeds, negative_prompt_embeds = encode_prompt_once(
+        pipe, prompt, negative_prompt, pipe.device, guidance_scale
+    )
+    for step, start in enumerate(range(0, len(indices), batch_size)):
+        if stop_event.is_set():
+            return
+        batch = indices[start:start + batch_size]
+        with metrics.profile(step), metrics.stage('generate', f"{batch[0]}-{batch[-1]}"):
+            images = generate_batch(
+                pipe, batch, prompt_embeds, negative_prompt_embeds, num_inference_steps, guidance_scale, seed
+            )
+        metrics.count('generated', len(batch))
+        metrics.sample_memory()
+        for i, image in zip(batch, images):
+            item = (i, cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2BGR))
+            # Время ожидания здесь — генератор простаивает, потому что разметка не успевает
+            with metrics.stage('queue_put_wait'):
+                # put с таймаутом, чтобы генератор не завис навсегда, если разметка упала
+                while not stop_event.is_set():
+                    try:
+                        image_queue.put(item, timeout=1.0)
+                        break
+                    except queue.Full:
+                        continue
+
+
+def run_generate_and_label(
+    pretrained_model_name_or_path,
+    lora_checkpoint_dir,
+    model_path,
+    label_out_dir,
+    image_out_dir,
+    prompt,
+    num_images,
+    num_inference_steps=30,
+    guidance_scale=7.5,
+    batch_size=1,
+    negative_prompt=None,
+    seed=0,
+    generation_device='cuda:0',
+    detection_device='cuda:0',
+    conf_threshold=0.7,
+    slice_size=768,
+    overlap_ratio=0.2,
+    object_class_id=14,
+    output_class_id=0,
+    queue_size=16,
+    writer_kwargs=None,
+    fused_unet_dir=None,
+    metrics=None,
+):
+    """
+    Generate images and label them in one process without an intermediate
+    directory. Generated images go through a bounded in-memory queue into
+    the detector; only images with at least one annotation and their YOLO
+    label files are written. Progress is logged in label_out_dir, so a
+    restart skips indices that were already labeled or rejected.
+    """
+    os.makedirs(label_out_dir, exist_ok=True)
+    os.makedirs(image_out_dir, exist_ok=True)
+    writer_kwargs = dict(writer_kwargs or {})
+    writer_kwargs['image_format'] = writer_kwargs.get('image_format') or 'png'
+    ext = EXTENSIONS[writer_kwargs['image_format']]
+    metrics = metrics or NULL_METRICS
+
+    progress = load_progress(label_out_dir)
+    indices = [i for i in range(num_images) if f"image_{i:04d}{ext}" not in progress]
+    if not indices:
+        print("Все изображения уже обработаны")
+        return
+
+    with metrics.stage('load_pipeline'):
+        pipe = load_pipeline(pretrained_model_name_or_path, lora_checkpoint_dir, generation_device, fused_unet_dir)
+    with metrics.stage('load_model'):
+        n_model = load_detection_model(model_path, conf_threshold, detection_device)
+
+    image_queue = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    producer_error = []
+
+    def producer():
+        try:
+            produce_images(
+                pipe, indices, image_queue, stop_event, prompt, negative_prompt,
+                num_inference_steps, guidance_scale, batch_size, seed, metrics,
+            )
+        except BaseException as e:
+            producer_error.append(e)
+        finally:
+            # Очередь может быть полна, а разметка уже остановлена: не блокируемся
+            while True:
+                try:
+                    image_queue.put(_DONE, timeout=1.0)
+                    break
+                except queue.Full:
+                    if stop_event.is_set():
+                        break
+
+    producer_thread = threading.Thread(target=producer, name='generation', daemon=True)
+    producer_thread.start()
+
+    accepted = rejected = 0
+    try:
+        with ProgressLog(label_out_dir) as progress_log, ImageWriter(metrics=metrics, **writer_kwargs) as writer:
+            with tqdm(total=len(indices)) as pbar:
+                while True:
+                    metrics.gauge('image_queue', image_queue.qsize())
+                    # Время ожидания здесь — детектор простаивает, потому что генерация не успевает
+                    with metrics.stage('queue_get_wait'):
+                        item = image_queue.get()
+                    if item is _DONE:
+                        break
+                    i, image = item
+                    img_name = f"image_{i:04d}{ext}"
+                    with metrics.stage('detect', img_name):
+                        annotations = detect_objects(
+                            image, n_model, slice_size, overlap_ratio, object_class_id, output_class_id
+                        )
+                    if annotations:
+                        metrics.count('accepted')
+                        metrics.count('boxes', len(annotations))
+                        with metrics.stage('write_labels', img_name):
+                            write_labels(os.path.join(label_out_dir, f"image_{i:04d}.txt"), annotations)
+                        # Отметка о готовности пишется только после того, как картинка легла на диск
+                        writer.submit(
+                            image,
+                            os.path.join(image_out_dir, img_name),
+                            on_written=lambda path, name=img_name: progress_log.mark(name, 'labeled'),
+                        )
+                        accepted += 1
+                    else:
+                        # Отбракованные изображения (ни одного бокса выше conf_threshold) на диск не попадают
+                        progress_log.mark(img_name, 'rejected')
+                        metrics.count('rejected')
+                        rejected += 1
+                    pbar.update(1)
+    finally:
+        stop_event.set()
+        producer_thread.join()
+
+    if producer_error:
+        raise producer_error[0]
+    print(f"Генерация и разметка завершены: сохранено {accepted}, отбраковано {rejected}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate images with Stable Diffusion + LoRA and label them with YOLOv8 + SAHI in one stream'
+    )
+    add_unet_source_args(parser)
+    parser.add_argument('--model_path', type=str, default='yolov8l.pt', help='Path to YOLOv8 model weights')
+    parser.add_argument('--label_out_dir', type=str, required=True, help='Directory to save label txt files')
+    parser.add_argument('--image_out_dir', type=str, required=True, help='Directory to save annotated images')
+    add_generation_args(parser)
+    parser.add_argument('--generation_device', type=str, default='cuda:0', help='Torch device for generation')
+    parser.add_argument('--detection_device', type=str, default='cuda:0', help='Torch device for detection')
+    parser.add_argument('--conf_threshold', type=float, default=0.7, help='Confidence threshold for detection')
+    parser.add_argument('--slice_size', type=int, default=768, help='Size of slice for SAHI inference')
+    parser.add_argument('--overlap_ratio', type=float, default=0.2, help='Overlap ratio for slicing')
+    parser.add_argument('--object_class_id', type=int, default=14, help='14 is original bird class ID in YOLO')
+    parser.add_argument('--output_class_id', type=int, default=0, help='Class ID to write in output labels')
+    parser.add_argument('--queue_size', type=int, default=16,
+                        help='Maximum number of generated images waiting for detection')
+    add_writer_args(parser)
+    add_metrics_args(parser)
+    args = parser.parse_args()
+    check_unet_source_args(parser, args)
+
+    with metrics_from_args(args) as metrics:
+        run_generate_and_label(
+            pretrained_model_name_or_path=args.pretrained_model_name_or_path,
+            lora_checkpoint_dir=args.lora_checkpoint_dir,
+            model_path=args.model_path,
+            label_out_dir=args.label_out_dir,
+            image_out_dir=args.image_out_dir,
+            prompt=args.prompt,
+            num_images=args.num_images,
+            num_inference_steps=args.num_inference_steps,
+            guidance_scale=args.guidance_scale,
+            batch_size=args.batch_size,
+            negative_prompt=args.negative_prompt,
+            seed=args.seed,
+            generation_device=args.generation_device,
+            detection_device=args.detection_device,
+            conf_threshold=args.conf_threshold,
+            slice_size=args.slice_size,
+            overlap_ratio=args.overlap_ratio,
+            object_class_id=args.object_class_id,
+            output_class_id=args.output_class_id,
+            queue_size=args.queue_size,
+            writer_kwargs=writer_kwargs_from_args(args),
+            fused_unet_dir=args.fused_unet_dir,
+            metrics=metrics,
+        )
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2025 Kirill Lekanov. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+from PIL import Image
+
+from instrumentation import NULL_METRICS
+
+EXTENSIONS = {
+    'png': '.png',
+    'webp': '.webp',
+    'jpeg': '.jpg',
+}
+
+
+def tmp_path_for(path):
+    return os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".tmp")
+
+
+def format_from_path(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.jpg', '.jpeg'):
+        return 'jpeg'
+    if ext in ('.png', '.webp'):
+        return ext[1:]
+    raise ValueError(f"Unsupported image extension: {path}")
+
+
+def encode_image(image, image_format, png_compression=None, jpeg_quality=None, webp_lossless=True, webp_quality=None):
+    """
+    Encode a PIL image or an OpenCV BGR array to bytes.
+    Options left as None keep the library defaults, so the bytes match a plain
+    image.save(path) / cv2.imwrite(path, image).
+    """
+    if isinstance(image, Image.Image):
+        params = {}
+        if image_format == 'png' and png_compression is not None:
+            params['compress_level'] = png_compression
+        elif image_format == 'jpeg' and jpeg_quality is not None:
+            params['quality'] = jpeg_quality
+        elif image_format == 'webp':
+            params['lossless'] = webp_lossless
+            if webp_quality is not None:
+                params['quality'] = webp_quality
+        buf = io.BytesIO()
+        image.save(buf, format=image_format.upper(), **params)
+        return buf.getvalue()
+
+    params = []
+    if image_format == 'png' and png_compression is not None:
+        params = [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+    elif image_format == 'jpeg' and jpeg_quality is not None:
+        params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+    elif image_format == 'webp':
+        # В OpenCV качество больше 100 означает lossless
+        if webp_lossless:
+            params = [cv2.IMWRITE_WEBP_QUALITY, 101]
+        elif webp_quality is not None:
+            params = [cv2.IMWRITE_WEBP_QUALITY, webp_quality]
+    ok, buf = cv2.imencode(EXTENSIONS[image_format], image, params)
+    if not ok:
+        raise RuntimeError(f"Failed to encode image as {image_format}")
+    return buf.tobytes()
+
+
+def write_bytes_atomic(data, path):
+    tmp_path = tmp_path_for(path)
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class ImageWriter:
+    """
+    Bounded background pool that encodes and writes images.
+
+    submit() blocks once max_pending images are queued, so producers cannot
+    run ahead of the disk. Leaving the `with` block waits for every pending
+    write and re-raises the first write error. PNG/WebP/JPEG encoders release
+    the GIL, so a thread pool overlaps encoding with GPU work. Encode and write
+    times, the pending-queue depth and the time producers spend blocked are
+    recorded in metrics.
+    """
+
+    def __init__(
+        self,
+        image_format=None,
+        png_compression=None,
+        jpeg_quality=None,
+        webp_lossless=True,
+        webp_quality=None,
+        num_workers=4,
+        max_pending=16,
+        metrics=None,
+    ):
+        if image_format is not None and image_format not in EXTENSIONS:
+            raise ValueError(f"image_format must be one of {sorted(EXTENSIONS)}, got {image_format}")
+        self.image_format = image_format
+        self.encode_options = {
+            'png_compression': png_compression,
+            'jpeg_quality': jpeg_quality,
+            'webp_lossless': webp_lossless,
+            'webp_quality': webp_quality,
+        }
+        self._executor = ThreadPoolExecutor(max_workers=num_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures = set()
+        self._lock = threading.Lock()
+        self._errors = []
+        self.metrics = metrics or NULL_METRICS
+
+    def output_path(self, path):
+        # Если формат задан, меняем расширение; иначе пишем в формате исходного имени
+        if self.image_format is None:
+            return path
+        return os.path.splitext(path)[0] + EXTENSIONS[self.image_format]
+
+    def submit(self, image, path, on_written=None):
+        """
+        Queue an image for writing and return the final path it will have.
+        on_written(path) is called from the writer thread once the file is on disk.
+        """
+        self._raise_errors()
+        path = self.output_path(path)
+        with self.metrics.stage('writer_wait'):
+            self._slots.acquire()
+        future = self._executor.submit(self._write, image, path, on_written)
+        with self._lock:
+            self._futures.add(future)
+            self.metrics.gauge('writer_pending', len(self._futures))
+        future.add_done_callback(self._on_done)
+        return path
+
+    def _write(self, image, path, on_written):
+        image_format = self.image_format or format_from_path(path)
+        name = os.path.basename(path)
+        with self.metrics.stage('encode', name):
+            data = encode_image(image, image_format, **self.encode_options)
+        with self.metrics.stage('write', name):
+            write_bytes_atomic(data, path)
+        if on_written is not None:
+            on_written(path)
+
+    def _on_done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+            if future.exception() is not None:
+                self._errors.append(future.exception())
+        self._slots.release()
+
+    def _raise_errors(self):
+        with self._lock:
+            if self._errors:
+                raise self._errors[0]
+
+    def flush(self):
+        """Wait until every submitted image is on disk."""
+        while True:
+            with self._lock:
+                pending = list(self._futures)
+            if not pending:
+                break
+            for future in pending:
+                future.exception()
+        self._raise_errors()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Исходное исключение важнее ошибок записи: дописываем очередь и не маскируем его
+            self._executor.shutdown(wait=True)
+
+
+def add_writer_args(parser):
+    parser.add_argument('--image_format', type=str, default=None, choices=sorted(EXTENSIONS),
+                        help='Output image format; by default keeps the format of the file name')
+    parser.add_argument('--png_compression', type=int, default=None,
+                        help='PNG compression level 0-9 (library default if not set)')
+    parser.add_argument('--jpeg_quality', type=int, default=None,
+                        help='JPEG quality 1-100 (library default if not set)')
+    parser.add_argument('--webp_lossy', action='store_true',
+                        help='Write lossy WebP instead of lossless')
+    parser.add_argument('--webp_quality', type=int, default=None,
+                        help='WebP quality 0-100 (for lossless WebP: compression effort in PIL)')
+    parser.add_argument('--writer_workers', type=int, default=4,
+                        help='Number of background threads encoding and writing images')
+    parser.add_argument('--writer_max_pending', type=int, default=16,
+                        help='Maximum number of images waiting to be written before the producer blocks')
+
+
+def reencodes(writer_kwargs):
+    """True if writer_kwargs change the format or any encoder option, i.e. images must be re-encoded."""
+    return (
+        writer_kwargs.get('image_format') is not None
+        or writer_kwargs.get('png_compression') is not None
+        or writer_kwargs.get('jpeg_quality') is not None
+        or writer_kwargs.get('webp_quality') is not None
+        or not writer_kwargs.get('webp_lossless', True)
+    )
+
+
+def writer_kwargs_from_args(args):
+    return {
+        'image_format': args.image_format,
+        'png_compression': args.png_compression,
+        'jpeg_quality': args.jpeg_quality,
+        'webp_lossless': not args.webp_lossy,
+        'webp_quality': args.webp_quality,
+        'num_workers': args.writer_workers,
+        'max_pending': args.writer_max_pending,
+    }
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2025 Kirill Lekanov. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+import threading
+from collections import defaultdict
+
+
+class _NullContext:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_CONTEXT = _NullContext()
+
+
+class NullMetrics:
+    """Disabled instrumentation: every call is a no-op, stage() returns a shared empty context."""
+
+    enabled = False
+
+    def stage(self, name, item=None, sync=False):
+        return _NULL_CONTEXT
+
+    def timed_iter(self, name, iterable):
+        return iterable
+
+    def record(self, name, duration, item=None):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def gauge(self, name, value):
+        pass
+
+    def sample_memory(self):
+        pass
+
+    def profile(self, step):
+        return _NULL_CONTEXT
+
+    def durations(self):
+        return {}
+
+    def close(self, quiet=False):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_METRICS = NullMetrics()
+
+
+class _Stage:
+    __slots__ = ('metrics', 'name', 'item', 'sync', 'start')
+
+    def __init__(self, metrics, name, item, sync):
+        self.metrics = metrics
+        self.name = name
+        self.item = item
+        self.sync = sync
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.sync:
+            _cuda_synchronize()
+        self.metrics.record(self.name, time.perf_counter() - self.start, self.item)
+        return False
+
+
+def _torch_cuda():
+    # torch не импортируется ради метрик: если модуль не загружен, GPU в процессе не используется
+    torch = sys.modules.get('torch')
+    if torch is None or not torch.cuda.is_available() or not torch.cuda.is_initialized():
+        return None
+    return torch.cuda
+
+
+def _cuda_synchronize():
+    cuda = _torch_cuda()
+    if cuda is not None:
+        cuda.synchronize()
+
+
+def _current_rss_mb():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss в килобайтах на Linux и в байтах на macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(who).ru_maxrss * scale / 2 ** 20
+
+
+def _percentile(sorted_values, q):
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100 * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def latency_stats(values):
+    """Count, total, mean, nearest-rank p50/p90/p99 and max of a list of durations in seconds."""
+    values = sorted(values)
+    total = sum(values)
+    return {
+        'count': len(values),
+        'total_s': total,
+        'mean_s': total / len(values),
+        'p50_s': _percentile(values, 50),
+        'p90_s': _percentile(values, 90),
+        'p99_s': _percentile(values, 99),
+        'max_s': values[-1],
+    }
+
+
+class Metrics:
+    """
+    Per-stage timings, counters, gauge high-water marks and memory usage.
+
+    Every timed stage is written to path as a JSON line as soon as it ends;
+    close() (called at interpreter exit at the latest) appends a summary
+    record with per-stage percentiles and prints it. All methods are
+    thread-safe, so ImageWriter and decode threads record into the same object.
+    Steps listed in profile_steps are traced with torch.profiler into
+    profile_dir as Chrome traces.
+    """
+
+    enabled = True
+
+    def __init__(self, path, profile_steps=None, profile_dir=None):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.profile_steps = set(profile_steps or ())
+        self.profile_dir = profile_dir or os.path.dirname(os.path.abspath(path))
+        self._file = open(path, 'a', buffering=1)
+        self._lock = threading.Lock()
+        self._durations = defaultdict(list)
+        self._counters = defaultdict(int)
+        self._gauges = {}
+        self._memory = {}
+        self._start = time.perf_counter()
+        self._closed = False
+        self._emit({'event': 'start', 'pid': os.getpid(), 'argv': sys.argv, 'time': time.time()})
+        atexit.register(self.close)
+
+    def _emit(self, record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            if not self._closed:
+                self._file.write(line)
+
+    def stage(self, name, item=None, sync=False):
+        """
+        Context manager timing one stage of one item. sync=True waits for
+        queued CUDA work before stopping the clock.
+        """
+        return _Stage(self, name, item, sync)
+
+    def timed_iter(self, name, iterable):
+        """Yield from iterable, recording the time spent waiting for each element as stage name."""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                value = next(iterator)
+            except StopIteration:
+                return
+            self.record(name, time.perf_counter() - start)
+            yield value
+
+    def record(self, name, duration, item=None):
+        with self._lock:
+            self._durations[name].append(duration)
+        event = {'event': 'stage', 'stage': name, 'duration_s': round(duration, 6),
+                 't': round(time.perf_counter() - self._start, 6)}
+        if item is not None:
+            event['item'] = item
+        self._emit(event)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counters[name] += n
+
+    def gauge(self, name, value):
+        """Track a queue depth or similar level; the summary keeps its maximum and mean."""
+        with self._lock:
+            peak, total, samples = self._gauges.get(name, (value, 0, 0))
+            self._gauges[name] = (max(peak, value), total + value, samples + 1)
+
+    def sample_memory(self):
+        """Update CPU RSS and GPU allocated-memory high-water marks."""
+        memory = {'cpu_peak_rss_mb': peak_rss_mb(resource.RUSAGE_SELF)}
+        rss = _current_rss_mb()
+        if rss is not None:
+            memory['cpu_rss_mb'] = rss
+        cuda = _torch_cuda()
+        if cuda is not None:
+            for device in range(cuda.device_count()):
+                memory[f"cuda:{device}_max_allocated_mb"] = cuda.max_memory_allocated(device) / 2 ** 20
+                memory[f"cuda:{device}_max_reserved_mb"] = cuda.max_memory_reserved(device) / 2 ** 20
+        with self._lock:
+            for key, value in memory.items():
+                self._memory[key] = max(self._memory.get(key, value), value)
+        return memory
+
+    def profile(self, step):
+        """Trace the wrapped step with torch.profiler if it is one of profile_steps."""
+        if step not in self.profile_steps:
+            return _NULL_CONTEXT
+        # Один трейс на шаг: при накоплении градиентов или новом чанке номер шага повторяется
+        self.profile_steps.discard(step)
+        return self._profile(step)
+
+    def _profile(self, step):
+        import torch
+        from contextlib import contextmanager
+
+        @contextmanager
+        def trace():
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            with torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True) as prof:
+                yield prof
+            os.makedirs(self.profile_dir, exist_ok=True)
+            trace_path = os.path.join(self.profile_dir, f"trace_step_{step}.json")
+            prof.export_chrome_trace(trace_path)
+            self._emit({'event': 'profile', 'step': step, 'trace': trace_path})
+
+        return trace()
+
+    def durations(self):
+        """Copy of every recorded duration, {stage: [seconds, ...]} in recording order."""
+        with self._lock:
+            return {name: list(values) for name, values in self._durations.items()}
+
+    def summary(self):
+        with self._lock:
+            durations = {name: list(values) for name, values in self._durations.items()}
+            counters = dict(self._counters)
+            gauges = {
+                name: {'max': peak, 'mean': total / samples}
+                for name, (peak, total, samples) in self._gauges.items()
+            }
+            memory = dict(self._memory)
+        return {
+            'event': 'summary',
+            'wall_s': time.perf_counter() - self._start,
+            'stages': {name: latency_stats(values) for name, values in durations.items()},
+            'counters': counters,
+            'gauges': gauges,
+            'memory': memory,
+        }
+
+    def close(self, quiet=False):
+        if self._closed:
+            return
+        self.sample_memory()
+        summary = self.summary()
+        # Пулы процессов (кроп) уже завершены к этому моменту, их пик учитывается отдельно
+        summary['memory']['children_peak_rss_mb'] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+        self._emit(summary)
+        with self._lock:
+            self._closed = True
+            self._file.close()
+        atexit.unregister(self.close)
+        if not quiet:
+            print_summary(summary)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def print_summary(summary):
+    print(f"[METRICS] wall time {summary['wall_s']:.1f} s")
+    for name, stats in sorted(summary['stages'].items(), key=lambda kv: -kv[1]['total_s']):
+        print(
+            f"[METRICS] {name:>20}: n={stats['count']:<6} total {stats['total_s']:9.2f} s  "
+            f"p50 {stats['p50_s'] * 1000:8.1f} ms  p90 {stats['p90_s'] * 1000:8.1f} ms  "
+            f"max {stats['max_s'] * 1000:8.1f} ms"
+        )
+    for name, value in sorted(summary['counters'].items()):
+        print(f"[METRICS] {name:>20}: {value}")
+    for name, stats in sorted(summary['gauges'].items()):
+        print(f"[METRICS] {name:>20}: max {stats['max']}, mean {stats['mean']:.1f}")
+    for name, value in sorted(summary['memory'].items()):
+        print(f"[METRICS] {name:>20}: {value:.0f} MB")
+
+
+def create_metrics(metrics_path=None, profile_steps=None, profile_dir=None):
+    """Metrics writing to metrics_path, or the shared no-op NULL_METRICS if it is None."""
+    if metrics_path is None:
+        return NULL_METRICS
+    return Metrics(metrics_path, profile_steps, profile_dir)
+
+
+def add_metrics_args(parser, profile=True):
+    parser.add_argument('--metrics_path', type=str, default=None,
+                        help='JSONL file for per-stage timings, counters and memory; disabled if not set')
+    if profile:
+        parser.add_argument('--profile_steps', type=int, nargs='+', default=None,
+                            help='Steps (batches) to trace with torch.profiler; requires --metrics_path')
+        parser.add_argument('--profile_dir', type=str, default=None,
+                            help='Where to save profiler traces (next to --metrics_path by default)')
+
+
+def metrics_from_args(args):
+    return create_metrics(
+        args.metrics_path, getattr(args, 'profile_steps', None), getattr(args, 'profile_dir', None)
+    )
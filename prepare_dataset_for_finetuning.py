@@ -14,15 +14,227 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
 import os
 import json
+import time
+import multiprocessing
 from PIL import Image
 import argparse
 import cv2
+import numpy as np
+
+from instrumentation import NULL_METRICS, add_metrics_args, metrics_from_args
+
+
+def read_good_birds(lbl_path, percent):
+    """
+    Read YOLO annotations and return an (N, 4) array of normalized
+    (cx, cy, w, h) of "good" birds (class 0 with w,h > percent).
+    """
+    birds = []
+    with open(lbl_path, 'r') as f:
+        for line in f:
+            parts = line.strip().split()
+            if len(parts) != 5:
+                continue
+            cls, cx, cy, w_norm, h_norm = parts
+            cls = int(cls)
+            cx, cy, w_n, h_n = map(float, [cx, cy, w_norm, h_norm])
+            # Filter good birds
+            if cls == 0 and w_n > percent and h_n > percent:
+                birds.append((cx, cy, w_n, h_n))
+    return np.array(birds, dtype=np.float64).reshape(-1, 4)
+
+
+def to_pixel_boxes(birds, W, H):
+    """Convert normalized (cx, cy, w, h) to pixel (xmin, ymin, xmax, ymax)."""
+    cx, cy, w_n, h_n = birds.T
+    bw = w_n * W
+    bh = h_n * H
+    bx = cx * W
+    by = cy * H
+    return np.stack([bx - bw/2, by - bh/2, bx + bw/2, by + bh/2], axis=1)
+
+
+def windows_with_good_bird(birds, W, H, crop_size, stride):
+    """
+    Return (x, y) corners of all sliding windows, in row-major order, that
+    fully contain at least one bird box. Every window is tested against
+    every box in one broadcast.
+    """
+    ys, xs = np.meshgrid(
+        np.arange(0, H - crop_size + 1, stride),
+        np.arange(0, W - crop_size + 1, stride),
+        indexing='ij',
+    )
+    xs = xs.ravel()[:, None]
+    ys = ys.ravel()[:, None]
+    inside = (
+        (birds[None, :, 0] >= xs) & (birds[None, :, 1] >= ys)
+        & (birds[None, :, 2] <= xs + crop_size) & (birds[None, :, 3] <= ys + crop_size)
+    )
+    has_good = inside.any(axis=1)
+    return list(zip(xs[has_good, 0].tolist(), ys[has_good, 0].tolist()))
+
+
+def crop_image(img_name, images_dir, labels_dir, output_dir, crop_size, percent, stride, output_format='files'):
+    """
+    Save all good-bird crops of one image and return their metadata records.
+    With output_format='arrow' nothing is written; each record carries the
+    encoded JPEG in 'bytes' for the shard writer.
+    """
+    base_name = os.path.splitext(img_name)[0]
+    lbl_path = os.path.join(labels_dir, base_name + '.txt')
+    img_path = os.path.join(images_dir, img_name)
+
+    # Skip images without labels
+    if not os.path.exists(lbl_path):
+        return []
+
+    birds = read_good_birds(lbl_path, percent)
+    if len(birds) == 0:
+        return []
+
+    # Image size is read from the header once; pixels are decoded on the first crop
+    with Image.open(img_path) as image:
+        W, H = image.size
+        birds = to_pixel_boxes(birds, W, H)
+        text = 'flying bird' if len(birds) == 1 else 'flying birds'
+        records = []
+        for crop_counter, (x, y) in enumerate(windows_with_good_bird(birds, W, H, crop_size, stride)):
+            # Crop and save
+            crop = image.crop((x, y, x + crop_size, y + crop_size))
+            crop_name = f"{base_name}_crop_{crop_counter:03d}.jpg"
+            if output_format == 'arrow':
+                # Same JPEG settings as crop.save(path) with a .jpg extension
+                buf = io.BytesIO()
+                crop.save(buf, format='JPEG')
+                records.append({'file_name': crop_name, 'text': text, 'bytes': buf.getvalue()})
+            else:
+                crop.save(os.path.join(output_dir, crop_name))
+                records.append({'file_name': crop_name, 'text': text})
+    return records
+
+
+def _crop_image_task(task):
+    # Time is measured in the worker, so it excludes waiting in the pool queue
+    start = time.perf_counter()
+    records = crop_image(*task)
+    return records, time.perf_counter() - start
+
+
+SPLITS = ('train', 'val', 'test')
+ARROW_INDEX_NAME = 'index.json'
+
+# Schema compatible with datasets.Image: the image column stores {bytes, path}
+ARROW_FEATURES = {
+    'image': {'_type': 'Image'},
+    'text': {'dtype': 'string', '_type': 'Value'},
+}
+
+
+class ArrowShardWriter:
+    """
+    Write crops into Arrow IPC stream shards of at most shard_size rows,
+    plus index.json listing the shards. datasets.Dataset.from_file
+    memory-maps the shards directly, so the training script needs no
+    directory scan.
+    """
+
+    def __init__(self, output_dir, shard_size, batch_rows=256):
+        # pyarrow is only needed for --output_format arrow, the default file output works without it
+        import pyarrow as pa
+
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.batch_rows = batch_rows
+        self.schema = pa.schema(
+            [
+                ('image', pa.struct([('bytes', pa.binary()), ('path', pa.string())])),
+                ('text', pa.string()),
+            ],
+            metadata={'huggingface': json.dumps({'info': {'features': ARROW_FEATURES}})},
+        )
+        self.shards = []
+        self._writer = None
+        self._tmp_path = None
+        self._rows_in_shard = 0
+        self._pending = []
+
+    def _open_shard(self):
+        import pyarrow as pa
+
+        shard_name = f"shard-{len(self.shards):05d}.arrow"
+        self._tmp_path = os.path.join(self.output_dir, shard_name + '.tmp')
+        self._writer = pa.ipc.new_stream(self._tmp_path, self.schema)
+        self.shards.append({'file': shard_name, 'num_rows': 0})
+
+    def _write_pending(self):
+        import pyarrow as pa
+
+        if not self._pending:
+            return
+        batch = pa.RecordBatch.from_arrays(
+            [
+                pa.array(
+                    [{'bytes': data, 'path': file_name} for file_name, data, _ in self._pending],
+                    type=self.schema.field('image').type,
+                ),
+                pa.array([text for _, _, text in self._pending], type=pa.string()),
+            ],
+            schema=self.schema,
+        )
+        self._writer.write_batch(batch)
+        self.shards[-1]['num_rows'] += len(self._pending)
+        self._pending = []
+
+    def _close_shard(self):
+        self._write_pending()
+        self._writer.close()
+        os.replace(self._tmp_path, os.path.join(self.output_dir, self.shards[-1]['file']))
+        self._writer = None
+        self._rows_in_shard = 0
+
+    def write(self, file_name, data, text):
+        if self._writer is None:
+            self._open_shard()
+        self._pending.append((file_name, data, text))
+        self._rows_in_shard += 1
+        if len(self._pending) >= self.batch_rows:
+            self._write_pending()
+        if self._rows_in_shard >= self.shard_size:
+            self._close_shard()
+
+    def close(self):
+        if self._writer is not None:
+            self._close_shard()
+        index = {
+            'num_rows': sum(shard['num_rows'] for shard in self.shards),
+            'shards': self.shards,
+        }
+        with open(os.path.join(self.output_dir, ARROW_INDEX_NAME), 'w') as f:
+            json.dump(index, f, indent=2)
+
+
+def list_splits(images_dir, labels_dir, output_dir):
+    """
+    Return (images_dir, labels_dir, output_dir) per dataset split. If
+    images_dir has train/val/test subfolders each of them is processed into
+    output_dir/<split>; otherwise images_dir is treated as a single split.
+    """
+    splits = [split for split in SPLITS if os.path.isdir(os.path.join(images_dir, split))]
+    if not splits:
+        return [(images_dir, labels_dir, output_dir)]
+    return [
+        (os.path.join(images_dir, split), os.path.join(labels_dir, split), os.path.join(output_dir, split))
+        for split in splits
+    ]
 
 
 def transfer_and_crop_good_birds(
-    images_dir, labels_dir, output_dir, crop_size, percent, stride
+    images_dir, labels_dir, output_dir, crop_size, percent, stride, num_workers=None,
+    output_format='files', shard_size=4096, metrics=None
 ):
     """
     For each image in train/val/test, read YOLO annotations,
@@ -30,86 +242,72 @@ def transfer_and_crop_good_birds(
     then slide a window of size crop_size and save all crops
     that fully contain at least one good bird bounding box.
     Also writes metadata.jsonl with {'file_name': ..., 'text': ...}.
+    Images are processed in a pool of num_workers processes; metadata is
+    merged in directory order, so the output matches a serial run.
+    With output_format='arrow' crops go into Arrow shards with index.json
+    instead of separate JPEG files.
+    Per-image crop times and crop counts are recorded in metrics.
     """
     # Use full step if stride not provided
     stride = stride or crop_size
+    num_workers = num_workers or os.cpu_count() or 1
+    metrics = metrics or NULL_METRICS
 
-    os.makedirs(output_dir, exist_ok=True)
-    meta_path = os.path.join(output_dir, 'metadata.jsonl')
+    pool = multiprocessing.Pool(num_workers) if num_workers > 1 else None
+    try:
+        for split_images_dir, split_labels_dir, split_output_dir in list_splits(images_dir, labels_dir, output_dir):
+            crop_split(
+                split_images_dir, split_labels_dir, split_output_dir, crop_size, percent, stride,
+                pool, output_format, shard_size, metrics
+            )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-    with open(meta_path, 'w') as meta_file:
-        for img_name in os.listdir(images_dir):
-            if not img_name.lower().endswith(('.jpg', '.jpeg', '.png')):
-                continue
 
-            base_name = os.path.splitext(img_name)[0]
-            lbl_path = os.path.join(labels_dir, base_name + '.txt')
-            img_path = os.path.join(images_dir, img_name)
+def crop_split(
+    images_dir, labels_dir, output_dir, crop_size, percent, stride, pool, output_format, shard_size,
+    metrics=NULL_METRICS
+):
+    os.makedirs(output_dir, exist_ok=True)
 
-            # Skip images without labels
-            if not os.path.exists(lbl_path):
-                continue
+    tasks = [
+        (img_name, images_dir, labels_dir, output_dir, crop_size, percent, stride, output_format)
+        for img_name in os.listdir(images_dir)
+        if img_name.lower().endswith(('.jpg', '.jpeg', '.png'))
+    ]
+    if pool is None:
+        results = map(_crop_image_task, tasks)
+    else:
+        # imap keeps the task order, so the output does not depend on the worker count
+        results = pool.imap(_crop_image_task, tasks, chunksize=4)
+    # Time the main process waits for results; if it is large, there are too few workers
+    results = metrics.timed_iter('crop_wait', results)
 
-            # Read annotations
-            birds = []  # list of (xmin, ymin, xmax, ymax)
-            with open(lbl_path, 'r') as f:
-                for line in f:
-                    parts = line.strip().split()
-                    if len(parts) != 5:
-                        continue
-                    cls, cx, cy, w_norm, h_norm = parts
-                    cls = int(cls)
-                    cx, cy, w_n, h_n = map(float, [cx, cy, w_norm, h_norm])
-                    # Filter good birds
-                    if cls == 0 and w_n > percent and h_n > percent:
-                        # Convert normalized coords to pixel coords
-                        with Image.open(img_path) as img:
-                            W, H = img.size
-                        bw = w_n * W
-                        bh = h_n * H
-                        bx = cx * W
-                        by = cy * H
-                        xmin = bx - bw/2
-                        ymin = by - bh/2
-                        xmax = bx + bw/2
-                        ymax = by + bh/2
-                        birds.append((xmin, ymin, xmax, ymax))
-
-            if not birds:
-                continue
+    def record(task, records, elapsed):
+        metrics.record('crop_image', elapsed, task[0])
+        metrics.count('images')
+        metrics.count('images_with_crops' if records else 'images_without_crops')
+        metrics.count('crops', len(records))
+
+    if output_format == 'arrow':
+        shard_writer = ArrowShardWriter(output_dir, shard_size)
+        for task, (records, elapsed) in zip(tasks, results):
+            record(task, records, elapsed)
+            with metrics.stage('shard_write', task[0]):
+                for meta in records:
+                    shard_writer.write(meta['file_name'], meta['bytes'], meta['text'])
+        shard_writer.close()
+        return
 
-            # Load image once per file
-            image = Image.open(img_path)
-            W, H = image.size
-            crop_counter = 0
-
-            # Slide window
-            for y in range(0, H - crop_size + 1, stride):
-                for x in range(0, W - crop_size + 1, stride):
-                    x2 = x + crop_size
-                    y2 = y + crop_size
-                    # Check if any bird bbox is fully inside window
-                    has_good = False
-                    for (xmin, ymin, xmax, ymax) in birds:
-                        if xmin >= x and ymin >= y and xmax <= x2 and ymax <= y2:
-                            has_good = True
-                            break
-                    if not has_good:
-                        continue
-
-                    # Crop and save
-                    crop = image.crop((x, y, x2, y2))
-                    crop_name = f"{base_name}_crop_{crop_counter:03d}.jpg"
-                    crop_path = os.path.join(output_dir, crop_name)
-                    crop.save(crop_path)
-
-                    # Metadata
-                    text = 'flying bird' if len(birds) == 1 else 'flying birds'
-                    meta = {'file_name': crop_name, 'text': text}
-                    meta_file.write(json.dumps(meta, ensure_ascii=False) + '\n')
-                    crop_counter += 1
-
-            image.close()
+    meta_path = os.path.join(output_dir, 'metadata.jsonl')
+    with open(meta_path, 'w') as meta_file:
+        for task, (records, elapsed) in zip(tasks, results):
+            record(task, records, elapsed)
+            for meta in records:
+                # Metadata
+                meta_file.write(json.dumps(meta, ensure_ascii=False) + '\n')
 
 
 if __name__ == "__main__":
@@ -130,17 +328,29 @@ if __name__ == "__main__":
                         help="Stride for sliding window. Defaults to crop_size if not set.")
     parser.add_argument("--text_label", type=str, required=True,
                         help="Text label for every image")
+    parser.add_argument("--num_workers", type=int, default=None,
+                        help="Number of worker processes. Defaults to the number of CPUs.")
+    parser.add_argument("--output_format", type=str, default="files", choices=["files", "arrow"],
+                        help="'files': JPEG per crop plus metadata.jsonl; 'arrow': sharded Arrow files plus index.json.")
+    parser.add_argument("--shard_size", type=int, default=4096,
+                        help="Maximum number of crops per Arrow shard.")
+    add_metrics_args(parser, profile=False)
     args = parser.parse_args()
 
     # If stride not provided, set to crop_size
     stride = args.stride or args.crop_size
 
-    transfer_and_crop_good_birds(
-        images_dir=args.images_dir,
-        labels_dir=args.labels_dir,
-        output_dir=args.output_dir,
-        crop_size=args.crop_size,
-        percent=args.percent,
-        stride=stride
-    )
+    with metrics_from_args(args) as metrics:
+        transfer_and_crop_good_birds(
+            images_dir=args.images_dir,
+            labels_dir=args.labels_dir,
+            output_dir=args.output_dir,
+            crop_size=args.crop_size,
+            percent=args.percent,
+            stride=stride,
+            num_workers=args.num_workers,
+            output_format=args.output_format,
+            shard_size=args.shard_size,
+            metrics=metrics
+        )
 
@@ -14,11 +14,141 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from diffusers import StableDiffusionPipeline
+from diffusers import StableDiffusionPipeline, UNet2DConditionModel
 import os
 import torch
 import argparse
 
+from image_writer import ImageWriter, EXTENSIONS, add_writer_args, writer_kwargs_from_args
+from instrumentation import NULL_METRICS, add_metrics_args, metrics_from_args
+
+def encode_prompt_once(pipe, prompt, negative_prompt, device, guidance_scale):
+    # Промпт один на весь прогон, поэтому текстовый энкодер вызывается один раз
+    with torch.no_grad():
+        prompt_embeds, negative_prompt_embeds = pipe.encode_prompt(
+            prompt,
+            device,
+            num_images_per_prompt=1,
+            do_classifier_free_guidance=guidance_scale > 1.0,
+            negative_prompt=negative_prompt,
+        )
+    return prompt_embeds, negative_prompt_embeds
+
+
+def generate_batch(
+    pipe,
+    indices,
+    prompt_embeds,
+    negative_prompt_embeds,
+    num_inference_steps,
+    guidance_scale,
+    seed,
+):
+    # Отдельный генератор на каждый индекс: картинка N не зависит от размера батча и от точки возобновления.
+    # Генераторы на CPU, чтобы шум совпадал на любом устройстве.
+    generators = [torch.Generator(device="cpu").manual_seed(seed + i) for i in indices]
+    n = len(indices)
+    if negative_prompt_embeds is not None:
+        negative_prompt_embeds = negative_prompt_embeds.repeat(n, 1, 1)
+    return pipe(
+        prompt_embeds=prompt_embeds.repeat(n, 1, 1),
+        negative_prompt_embeds=negative_prompt_embeds,
+        num_inference_steps=num_inference_steps,
+        guidance_scale=guidance_scale,
+        generator=generators,
+    ).images
+
+
+def load_fused_unet(fused_unet_dir):
+    # safetensors memory-mapped, веса не инициализируются случайно перед загрузкой
+    return UNet2DConditionModel.from_pretrained(fused_unet_dir, low_cpu_mem_usage=True)
+
+
+def load_pipeline(pretrained_model_name_or_path, lora_checkpoint_dir, device, fused_unet_dir=None):
+    if fused_unet_dir is not None:
+        # UNet с уже объединенными весами LoRA (export_fused_lora.py): базовый UNet не загружается вовсе
+        pipe = StableDiffusionPipeline.from_pretrained(
+            pretrained_model_name_or_path, unet=load_fused_unet(fused_unet_dir)
+        )
+    else:
+        pipe = StableDiffusionPipeline.from_pretrained(pretrained_model_name_or_path)
+        pipe.unet.load_attn_procs(lora_checkpoint_dir)
+    pipe.to(torch.device(device))
+    pipe.set_progress_bar_config(disable=True)
+    return pipe
+
+
+def add_unet_source_args(parser):
+    parser.add_argument('--pretrained_model_name_or_path', type=str, default='stabilityai/stable-diffusion-2',
+                        help='Pretrained Stable Diffusion repo or path')
+    parser.add_argument('--lora_checkpoint_dir', type=str, default=None,
+                        help='Directory with LoRA attention processors')
+    parser.add_argument('--fused_unet_dir', type=str, default=None,
+                        help='UNet snapshot with merged LoRA weights from export_fused_lora.py, used instead of '
+                             '--lora_checkpoint_dir')
+
+
+def check_unet_source_args(parser, args):
+    if (args.lora_checkpoint_dir is None) == (args.fused_unet_dir is None):
+        parser.error('exactly one of --lora_checkpoint_dir and --fused_unet_dir is required')
+
+
+def add_generation_args(parser):
+    parser.add_argument('--prompt', type=str,
+                        default='A photo of flying photorealistic white bird in a photorealistic environment',
+                        help='Text prompt for generation')
+    parser.add_argument('--negative_prompt', type=str, default=None,
+                        help='Negative text prompt for classifier-free guidance')
+    parser.add_argument('--num_inference_steps', type=int, default=30,
+                        help='Number of inference steps')
+    parser.add_argument('--guidance_scale', type=float, default=7.5,
+                        help='Guidance scale')
+    parser.add_argument('--num_images', type=int, default=10000,
+                        help='Total number of images to generate')
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help='Number of images denoised together in one UNet batch')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Base seed; image i is generated with seed + i')
+
+
+def image_path(output_dir, i, image_format='png'):
+    return os.path.join(output_dir, f"image_{i:04d}{EXTENSIONS[image_format]}")
+
+
+def missing_indices(output_dir, indices, image_format='png'):
+    # Файл появляется только после os.replace, поэтому наличие файла означает, что картинка записана целиком
+    existing = set(os.listdir(output_dir))
+    return [i for i in indices if os.path.basename(image_path(output_dir, i, image_format)) not in existing]
+
+
+def generate_images(
+    pipe,
+    indices,
+    output_dir,
+    writer,
+    prompt_embeds,
+    negative_prompt_embeds,
+    num_inference_steps,
+    guidance_scale,
+    batch_size=1,
+    seed=0,
+    metrics=NULL_METRICS,
+):
+    for step, start in enumerate(range(0, len(indices), batch_size)):
+        batch = indices[start:start + batch_size]
+        print("Generating images", batch[0], "-", batch[-1])
+        # Шаг профилирования — номер батча в этом запуске
+        with metrics.profile(step), metrics.stage('generate', f"{batch[0]}-{batch[-1]}"):
+            images = generate_batch(
+                pipe, batch, prompt_embeds, negative_prompt_embeds, num_inference_steps, guidance_scale, seed
+            )
+        metrics.count('generated', len(batch))
+        metrics.sample_memory()
+        # Кодирование и запись идут в фоне, пока UNet считает следующий батч
+        for i, image in zip(batch, images):
+            writer.submit(image, image_path(output_dir, i, writer.image_format))
+
+
 def run_inference(
     pretrained_model_name_or_path,
     lora_checkpoint_dir,
@@ -28,48 +158,71 @@ def run_inference(
     num_inference_steps,
     guidance_scale,
     num_images,
+    batch_size=1,
+    negative_prompt=None,
+    seed=0,
+    writer_kwargs=None,
+    fused_unet_dir=None,
+    metrics=None,
 ):
     os.makedirs(output_dir, exist_ok=True)
-    _device = torch.device(device)
-    pipe = StableDiffusionPipeline.from_pretrained(pretrained_model_name_or_path)
-    pipe.unet.load_attn_procs(lora_checkpoint_dir)
-    pipe.to(_device)
+    metrics = metrics or NULL_METRICS
+    writer_kwargs = dict(writer_kwargs or {})
+    writer_kwargs['image_format'] = writer_kwargs.get('image_format') or 'png'
 
-    resume = max([-1] + [int(img_name.split(".")[0][-4:]) for img_name in os.listdir(output_dir)])
-    for i in range(resume+1, num_images):
-        print("Generating", i, "image")
-        image = pipe(prompt, num_inference_steps=num_inference_steps, guidance_scale=guidance_scale).images[0]
-        image.save(f"{output_dir}_image_{i:04d}.png")
+    # Возобновление: генерируем только отсутствующие индексы
+    indices = missing_indices(output_dir, range(num_images), writer_kwargs['image_format'])
+    if not indices:
+        return
+    with metrics.stage('load_pipeline'):
+        pipe = load_pipeline(pretrained_model_name_or_path, lora_checkpoint_dir, device, fused_unet_dir)
+    with metrics.stage('encode_prompt', sync=True):
+        prompt_embeds, negative_prompt_embeds = encode_prompt_once(
+            pipe, prompt, negative_prompt, pipe.device, guidance_scale
+        )
+    with ImageWriter(metrics=metrics, **writer_kwargs) as writer:
+        generate_images(
+            pipe,
+            indices,
+            output_dir,
+            writer,
+            prompt_embeds,
+            negative_prompt_embeds,
+            num_inference_steps,
+            guidance_scale,
+            batch_size=batch_size,
+            seed=seed,
+            metrics=metrics,
+        )
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Inference with Stable Diffusion + LoRA checkpoint')
-    parser.add_argument('--pretrained_model_name_or_path', type=str, default='stabilityai/stable-diffusion-2',
-                        help='Pretrained Stable Diffusion repo or path')
-    parser.add_argument('--lora_checkpoint_dir', type=str, required=True,
-                        help='Directory with LoRA attention processors')
+    add_unet_source_args(parser)
     parser.add_argument('--output_dir', type=str, default='./inference_images/',
                         help='Where to save generated images')
-    parser.add_argument('--prompt', type=str,
-                        default='A photo of flying photorealistic white bird in a photorealistic environment',
-                        help='Text prompt for generation')
     parser.add_argument('--device', type=str, default='cuda:0',
                         help='Torch device (e.g., cuda:0 or cpu)')
-    parser.add_argument('--num_inference_steps', type=int, default=30,
-                        help='Number of inference steps')
-    parser.add_argument('--guidance_scale', type=float, default=7.5,
-                        help='Guidance scale')
-    parser.add_argument('--num_images', type=int, default=10000,
-                        help='Total number of images to generate')
+    add_generation_args(parser)
+    add_writer_args(parser)
+    add_metrics_args(parser)
     args = parser.parse_args()
+    check_unet_source_args(parser, args)
 
-    run_inference(
-        pretrained_model_name_or_path=args.pretrained,
-        lora_checkpoint_dir=args.lora_checkpoint_dir,
-        output_dir=args.output_dir,
-        prompt=args.prompt,
-        device=args.device,
-        num_inference_steps=args.num_inference_steps,
-        guidance_scale=args.guidance_scale,
-        num_images=args.num_images
-    )
+    with metrics_from_args(args) as metrics:
+        run_inference(
+            pretrained_model_name_or_path=args.pretrained_model_name_or_path,
+            lora_checkpoint_dir=args.lora_checkpoint_dir,
+            output_dir=args.output_dir,
+            prompt=args.prompt,
+            device=args.device,
+            num_inference_steps=args.num_inference_steps,
+            guidance_scale=args.guidance_scale,
+            num_images=args.num_images,
+            batch_size=args.batch_size,
+            negative_prompt=args.negative_prompt,
+            seed=args.seed,
+            writer_kwargs=writer_kwargs_from_args(args),
+            fused_unet_dir=args.fused_unet_dir,
+            metrics=metrics,
+        )
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2025 Kirill Lekanov. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import fcntl
+import argparse
+import multiprocessing
+
+from sd_sampling_after_finetuning_lora import (
+    load_pipeline,
+    encode_prompt_once,
+    generate_images,
+    missing_indices,
+    image_path,
+    add_unet_source_args,
+    check_unet_source_args,
+    add_generation_args,
+)
+from image_writer import ImageWriter, tmp_path_for, add_writer_args, writer_kwargs_from_args
+from instrumentation import create_metrics, add_metrics_args
+
+MANIFEST_NAME = 'manifest.json'
+CLAIMS_DIR = '.claims'
+
+# Параметры, от которых зависят пиксели картинки, и chunk_size, задающий диапазоны блокировок:
+# при возобновлении они должны совпадать
+MANIFEST_KEYS = (
+    'pretrained_model_name_or_path',
+    'lora_checkpoint_dir',
+    'fused_unet_dir',
+    'prompt',
+    'negative_prompt',
+    'num_inference_steps',
+    'guidance_scale',
+    'seed',
+    'chunk_size',
+    'image_format',
+)
+
+
+def read_manifest(manifest_path, timeout=60.0):
+    # Файл уже создан, но создатель может еще дописывать его: ждем, пока JSON станет полным
+    deadline = time.monotonic() + timeout
+    while True:
+        with open(manifest_path, 'r') as f:
+            content = f.read()
+        try:
+            return json.loads(content)
+        except json.JSONDecodeError:
+            if time.monotonic() > deadline:
+                raise ValueError(
+                    f"{manifest_path} is incomplete; if no worker is starting, delete it and rerun"
+                )
+            time.sleep(0.5)
+
+
+def init_manifest(output_dir, config):
+    """
+    Create manifest.json in output_dir, or check that an existing one
+    was written with the same generation parameters.
+    """
+    os.makedirs(os.path.join(output_dir, CLAIMS_DIR), exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    manifest = {key: config[key] for key in MANIFEST_KEYS}
+
+    try:
+        # O_EXCL: манифест создает ровно один воркер; в отличие от os.link работает и на FS без hardlink
+        fd = os.open(manifest_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        pass
+    else:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+
+    existing = read_manifest(manifest_path)
+    mismatched = [key for key in MANIFEST_KEYS if existing.get(key) != manifest[key]]
+    if mismatched:
+        raise ValueError(
+            f"{manifest_path} was written with different parameters: {', '.join(mismatched)}. "
+            f"Use a new output_dir or the original parameters."
+        )
+    return existing
+
+
+def chunk_ranges(num_images, chunk_size):
+    return [(start, min(start + chunk_size, num_images)) for start in range(0, num_images, chunk_size)]
+
+
+def try_claim(output_dir, start, end):
+    """
+    Take an exclusive lock on the chunk [start, end). The lock is released by the
+    OS when the worker exits or crashes, so a restart can reclaim the chunk.
+    Returns an open file descriptor or None if another worker holds the chunk.
+    """
+    lock_path = os.path.join(output_dir, CLAIMS_DIR, f"{start:06d}-{end:06d}.lock")
+    fd = os.open(lock_path, os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def release_claim(fd):
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+def remove_partial_files(output_dir, indices, image_format):
+    # Недописанные временные файлы остаются после падения воркера; чанк уже захвачен, удалять безопасно
+    for i in indices:
+        tmp_path = tmp_path_for(image_path(output_dir, i, image_format))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def worker_metrics_path(metrics_path, worker_rank):
+    # Свой файл на каждый воркер: процессы не пишут в один JSONL
+    if metrics_path is None:
+        return None
+    root, ext = os.path.splitext(metrics_path)
+    return f"{root}.worker{worker_rank}{ext or '.jsonl'}"
+
+
+def worker_loop(
+    worker_rank,
+    num_workers,
+    config,
+    device,
+    pipeline_loader=load_pipeline,
+):
+    output_dir = config['output_dir']
+    image_format = config['image_format']
+    chunks = chunk_ranges(config['num_images'], config['chunk_size'])
+    # Каждый воркер начинает со своего места в списке чанков, чтобы реже сталкиваться за блокировки
+    offset = worker_rank * len(chunks) // max(num_workers, 1)
+    chunks = chunks[offset:] + chunks[:offset]
+
+    pipe = None
+    prompt_embeds = negative_prompt_embeds = None
+    generated = 0
+    metrics = create_metrics(worker_metrics_path(config.get('metrics_path'), worker_rank))
+    writer = ImageWriter(metrics=metrics, **config['writer_kwargs'])
+    for start, end in chunks:
+        if not missing_indices(output_dir, range(start, end), image_format):
+            continue
+        fd = try_claim(output_dir, start, end)
+        if fd is None:
+            metrics.count('chunks_busy')
+            continue
+        metrics.count('chunks_claimed')
+        try:
+            # Перепроверяем после захвата: чанк мог быть дописан другим воркером
+            indices = missing_indices(output_dir, range(start, end), image_format)
+            if not indices:
+                continue
+            remove_partial_files(output_dir, indices, image_format)
+            if pipe is None:
+                # fused_unet_dir передается только если задан: загрузчики с тремя аргументами продолжают работать
+                loader_kwargs = {}
+                if config['fused_unet_dir'] is not None:
+                    loader_kwargs['fused_unet_dir'] = config['fused_unet_dir']
+                with metrics.stage('load_pipeline'):
+                    pipe = pipeline_loader(
+                        config['pretrained_model_name_or_path'], config['lora_checkpoint_dir'], device,
+                        **loader_kwargs,
+                    )
+                prompt_embeds, negative_prompt_embeds = encode_prompt_once(
+                    pipe, config['prompt'], config['negative_prompt'], pipe.device, config['guidance_scale']
+                )
+            generate_images(
+                pipe,
+                indices,
+                output_dir,
+                writer,
+                prompt_embeds,
+                negative_prompt_embeds,
+                config['num_inference_steps'],
+                config['guidance_scale'],
+                batch_size=config['batch_size'],
+                seed=config['seed'],
+                metrics=metrics,
+            )
+            generated += len(indices)
+        finally:
+            # Чанк отпускаем только когда все его картинки на диске
+            try:
+                with metrics.stage('flush_chunk', f"{start}-{end}"):
+                    writer.flush()
+            finally:
+                release_claim(fd)
+    writer.close()
+    metrics.close()
+    print(f"[worker {worker_rank} on {device}] generated {generated} images")
+    return generated
+
+
+def run_sharded_inference(
+    pretrained_model_name_or_path,
+    lora_checkpoint_dir,
+    output_dir,
+    prompt,
+    devices,
+    num_inference_steps,
+    guidance_scale,
+    num_images,
+    batch_size=1,
+    negative_prompt=None,
+    seed=0,
+    chunk_size=64,
+    workers_per_device=1,
+    pipeline_loader=load_pipeline,
+    writer_kwargs=None,
+    fused_unet_dir=None,
+    metrics_path=None,
+):
+    writer_kwargs = dict(writer_kwargs or {})
+    writer_kwargs['image_format'] = writer_kwargs.get('image_format') or 'png'
+    config = {
+        'pretrained_model_name_or_path': pretrained_model_name_or_path,
+        'lora_checkpoint_dir': lora_checkpoint_dir,
+        'fused_unet_dir': fused_unet_dir,
+        'output_dir': output_dir,
+        'prompt': prompt,
+        'negative_prompt': negative_prompt,
+        'num_inference_steps': num_inference_steps,
+        'guidance_scale': guidance_scale,
+        'num_images': num_images,
+        'batch_size': batch_size,
+        'seed': seed,
+        'chunk_size': chunk_size,
+        'image_format': writer_kwargs['image_format'],
+        'writer_kwargs': writer_kwargs,
+        'metrics_path': metrics_path,
+    }
+    os.makedirs(output_dir, exist_ok=True)
+    init_manifest(output_dir, config)
+
+    worker_devices = [device for device in devices for _ in range(workers_per_device)]
+    num_workers = len(worker_devices)
+    if num_workers == 1:
+        worker_loop(0, 1, config, worker_devices[0], pipeline_loader)
+    else:
+        # spawn: CUDA нельзя инициализировать в процессе, полученном через fork
+        ctx = multiprocessing.get_context('spawn')
+        processes = [
+            ctx.Process(target=worker_loop, args=(rank, num_workers, config, device, pipeline_loader))
+            for rank, device in enumerate(worker_devices)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        failed = [rank for rank, process in enumerate(processes) if process.exitcode != 0]
+        if failed:
+            raise RuntimeError(f"Generation workers {failed} failed; rerun to regenerate the missing images")
+
+    # Недостающие индексы могут быть у воркеров на других машинах с общим output_dir
+    remaining = missing_indices(output_dir, range(num_images), config['image_format'])
+    if remaining:
+        print(f"[WARN] {len(remaining)} images are still missing or claimed by other workers, rerun to finish them")
+    else:
+        print("Генерация завершена:", num_images, "изображений в", output_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sharded multi-worker inference with Stable Diffusion + LoRA')
+    add_unet_source_args(parser)
+    parser.add_argument('--output_dir', type=str, default='./inference_images/',
+                        help='Where to save generated images')
+    parser.add_argument('--devices', type=str, default='cuda:0',
+                        help='Comma-separated torch devices, one worker group per device (e.g., cuda:0,cuda:1)')
+    parser.add_argument('--workers_per_device', type=int, default=1,
+                        help='Number of worker processes per device')
+    add_generation_args(parser)
+    parser.add_argument('--chunk_size', type=int, default=64,
+                        help='Number of image indices a worker claims at once')
+    add_writer_args(parser)
+    add_metrics_args(parser, profile=False)
+    args = parser.parse_args()
+    check_unet_source_args(parser, args)
+
+    run_sharded_inference(
+        pretrained_model_name_or_path=args.pretrained_model_name_or_path,
+        lora_checkpoint_dir=args.lora_checkpoint_dir,
+        output_dir=args.output_dir,
+        prompt=args.prompt,
+        devices=args.devices.split(','),
+        num_inference_steps=args.num_inference_steps,
+        guidance_scale=args.guidance_scale,
+        num_images=args.num_images,
+        batch_size=args.batch_size,
+        negative_prompt=args.negative_prompt,
+        seed=args.seed,
+        chunk_size=args.chunk_size,
+        workers_per_device=args.workers_per_device,
+        writer_kwargs=writer_kwargs_from_args(args),
+        fused_unet_dir=args.fused_unet_dir,
+        metrics_path=args.metrics_path,
+    )
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2025 Kirill Lekanov. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import defaultdict
+from functools import lru_cache
+
+import numpy as np
+from ultralytics import YOLO
+
+
+@lru_cache(maxsize=None)
+def slice_grid(image_height, image_width, slice_height, slice_width, overlap_ratio):
+    """
+    Slice boxes (xmin, ymin, xmax, ymax) for an image size, in the same order
+    and with the same edge handling as sahi.slicing.get_slice_bboxes.
+    Computed once per image size.
+    """
+    slice_bboxes = []
+    y_max = y_min = 0
+    y_overlap = int(overlap_ratio * slice_height)
+    x_overlap = int(overlap_ratio * slice_width)
+    while y_max < image_height:
+        x_min = x_max = 0
+        y_max = y_min + slice_height
+        while x_max < image_width:
+            x_max = x_min + slice_width
+            if y_max > image_height or x_max > image_width:
+                xmax = min(image_width, x_max)
+                ymax = min(image_height, y_max)
+                xmin = max(0, xmax - slice_width)
+                ymin = max(0, ymax - slice_height)
+                slice_bboxes.append((xmin, ymin, xmax, ymax))
+            else:
+                slice_bboxes.append((x_min, y_min, x_max, y_max))
+            x_min = x_max - x_overlap
+        y_min = y_max - y_overlap
+    grid = np.array(slice_bboxes, dtype=np.int64)
+    grid.setflags(write=False)
+    return grid
+
+
+def match_values(box, boxes, match_metric):
+    xx1 = np.maximum(boxes[:, 0], box[0])
+    yy1 = np.maximum(boxes[:, 1], box[1])
+    xx2 = np.minimum(boxes[:, 2], box[2])
+    yy2 = np.minimum(boxes[:, 3], box[3])
+    inter = np.clip(xx2 - xx1, 0, None) * np.clip(yy2 - yy1, 0, None)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    if match_metric == 'IOU':
+        return inter / (areas + area - inter)
+    if match_metric == 'IOS':
+        return inter / np.minimum(areas, area)
+    raise ValueError(f"Unknown match metric {match_metric}")
+
+
+def greedy_nmm(detections, match_threshold=0.5, match_metric='IOS'):
+    """
+    Greedy non-maximum merging of (N, 5) [xmin, ymin, xmax, ymax, score]
+    detections of one class, equivalent to SAHI's GreedyNMMPostprocess:
+    the highest-scoring box absorbs every remaining box that still matches
+    the growing merged box. Returns merged detections in descending score order.
+    """
+    if len(detections) == 0:
+        return detections
+    boxes = detections[:, :4]
+    scores = detections[:, 4]
+    order = np.argsort(scores, kind='stable')
+    merged = []
+    while len(order) > 0:
+        idx = order[-1]
+        order = order[:-1]
+        keep = detections[idx].copy()
+        if len(order) == 0:
+            merged.append(keep)
+            break
+        matched = match_values(boxes[idx], boxes[order], match_metric) >= match_threshold
+        # Кандидаты на слияние в порядке убывания score; повторная проверка строгая, как has_match в SAHI
+        for merge_idx in order[matched][::-1]:
+            if match_values(keep[:4], boxes[merge_idx][None], match_metric)[0] > match_threshold:
+                keep[0] = min(keep[0], boxes[merge_idx, 0])
+                keep[1] = min(keep[1], boxes[merge_idx, 1])
+                keep[2] = max(keep[2], boxes[merge_idx, 2])
+                keep[3] = max(keep[3], boxes[merge_idx, 3])
+                keep[4] = max(keep[4], scores[merge_idx])
+        merged.append(keep)
+        unmatched = order[~matched]
+        order = unmatched[np.argsort(scores[unmatched], kind='stable')]
+    return np.stack(merged)
+
+
+def to_yolo_annotations(detections, image_height, image_width, output_class_id):
+    if len(detections) == 0:
+        return []
+    xmin, ymin, xmax, ymax = detections[:, 0], detections[:, 1], detections[:, 2], detections[:, 3]
+    x_center = ((xmin + xmax) / 2) / image_width
+    y_center = ((ymin + ymax) / 2) / image_height
+    width = (xmax - xmin) / image_width
+    height = (ymax - ymin) / image_height
+    return [
+        (output_class_id, float(xc), float(yc), float(bw), float(bh))
+        for xc, yc, bw, bh in zip(x_center, y_center, width, height)
+    ]
+
+
+class BatchedSlicedDetector:
+    """
+    Sliced YOLO inference that packs slices from several images into
+    fixed-size detector batches.
+
+    Slices stay views of the input images until a batch is packed. Slices of
+    the same shape share a batch, so every batch is letterboxed the way a
+    single SAHI call would be. As in SAHI, YOLO runs on all classes (so its
+    max_det limit applies across classes) and object_class_id is selected
+    afterwards; the cross-slice merge is done per image in NumPy.
+
+    SAHI reads the cv2 BGR array as RGB and reverses the channels again before
+    calling YOLO. With sahi_channel_order=True the same input is reproduced, so
+    labels match run_detection with SAHI.
+    """
+
+    def __init__(
+        self,
+        model_path,
+        conf_threshold,
+        device,
+        slice_size,
+        overlap_ratio,
+        object_class_id,
+        batch_size=16,
+        perform_standard_pred=True,
+        match_threshold=0.5,
+        match_metric='IOS',
+        image_size=None,
+        sahi_channel_order=True,
+    ):
+        self.model = YOLO(model_path)
+        self.conf_threshold = conf_threshold
+        self.device = device
+        self.slice_size = slice_size
+        self.overlap_ratio = overlap_ratio
+        self.object_class_id = object_class_id
+        self.batch_size = batch_size
+        self.perform_standard_pred = perform_standard_pred
+        self.match_threshold = match_threshold
+        self.match_metric = match_metric
+        self.image_size = image_size
+        self.sahi_channel_order = sahi_channel_order
+
+    def _predict(self, arrays):
+        kwargs = {
+            'conf': self.conf_threshold,
+            'device': self.device,
+            'verbose': False,
+        }
+        if self.image_size is not None:
+            kwargs['imgsz'] = self.image_size
+        results = self.model.predict(arrays, **kwargs)
+        detections = []
+        for r in results:
+            # Фильтр класса после NMS и max_det, как в SAHI, а не через predict(classes=...)
+            data = r.boxes.data.cpu().numpy().astype(np.float64)
+            keep = (data[:, 5] == self.object_class_id) & (data[:, 4] >= self.conf_threshold)
+            detections.append(data[keep, :5])
+        return detections
+
+    def num_tiles(self, image_height, image_width):
+        """Number of detector inputs for one image of this size: its slices plus the full-image pass."""
+        num_slices = len(slice_grid(image_height, image_width, self.slice_size, self.slice_size, self.overlap_ratio))
+        return num_slices + 1 if self.perform_standard_pred and num_slices > 1 else num_slices
+
+    def _tiles(self, image):
+        h, w = image.shape[:2]
+        if self.sahi_channel_order:
+            image = image[:, :, ::-1]
+        grid = slice_grid(h, w, self.slice_size, self.slice_size, self.overlap_ratio)
+        for xmin, ymin, xmax, ymax in grid:
+            yield image[ymin:ymax, xmin:xmax], xmin, ymin
+        # Как в SAHI: предсказание по целому изображению добавляется, только если слайсов больше одного
+        if self.perform_standard_pred and len(grid) > 1:
+            yield image, 0, 0
+
+    def detect(self, images):
+        """
+        Run sliced detection on a list of BGR images. Returns, per image, an
+        (N, 5) array [xmin, ymin, xmax, ymax, score] of merged detections.
+        """
+        per_image = [[] for _ in images]
+        buckets = defaultdict(list)
+
+        def flush(bucket):
+            arrays = [np.ascontiguousarray(tile) for tile, _, _, _ in bucket]
+            for (_, image_idx, x_off, y_off), dets in zip(bucket, self._predict(arrays)):
+                dets[:, [0, 2]] += x_off
+                dets[:, [1, 3]] += y_off
+                per_image[image_idx].append(dets)
+            bucket.clear()
+
+        for image_idx, image in enumerate(images):
+            for tile, x_off, y_off in self._tiles(image):
+                bucket = buckets[tile.shape]
+                bucket.append((tile, image_idx, x_off, y_off))
+                if len(bucket) == self.batch_size:
+                    flush(bucket)
+        for bucket in buckets.values():
+            if bucket:
+                flush(bucket)
+
+        merged = []
+        for dets in per_image:
+            dets = np.concatenate(dets) if dets else np.zeros((0, 5))
+            merged.append(greedy_nmm(dets, self.match_threshold, self.match_metric))
+        return merged
+
+    def detect_annotations(self, images, output_class_id):
+        """Same as detect(), but returns YOLO-format annotations per image."""
+        return [
+            to_yolo_annotations(dets, image.shape[0], image.shape[1], output_class_id)
+            for image, dets in zip(images, self.detect(images))
+        ]
@@ -13,14 +13,22 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+#
+# Modified from the diffusers example: sharded Arrow dataset loading, a precomputed VAE latent cache,
+# caching of text-encoder outputs for unique captions and per-stage timing via instrumentation.py.
 """Fine-tuning script for Stable Diffusion for text2image with support for LoRA."""
 
 import argparse
+import hashlib
+import io
+import json
 import logging
 import math
 import os
 import random
 import shutil
+import sys
+from collections import OrderedDict
 from contextlib import nullcontext
 from pathlib import Path
 
@@ -33,17 +41,19 @@ import transformers
 from accelerate import Accelerator
 from accelerate.logging import get_logger
 from accelerate.utils import ProjectConfiguration, set_seed
-from datasets import load_dataset
+from datasets import Dataset, DatasetDict, concatenate_datasets, load_dataset
 from huggingface_hub import create_repo, upload_folder
 from packaging import version
 from peft import LoraConfig
 from peft.utils import get_peft_model_state_dict
+from PIL import Image
 from torchvision import transforms
 from tqdm.auto import tqdm
 from transformers import CLIPTextModel, CLIPTokenizer
 
 import diffusers
 from diffusers import AutoencoderKL, DDPMScheduler, DiffusionPipeline, StableDiffusionPipeline, UNet2DConditionModel
+from diffusers.models.autoencoders.vae import DiagonalGaussianDistribution
 from diffusers.optimization import get_scheduler
 from diffusers.training_utils import cast_training_params, compute_snr
 from diffusers.utils import check_min_version, convert_state_dict_to_diffusers, is_wandb_available
@@ -52,6 +62,12 @@ from diffusers.utils.import_utils import is_xformers_available
 from diffusers.utils.torch_utils import is_compiled_module
 
 
+# instrumentation.py lives in the repository root, one level above this script. The root is appended, not
+# prepended, so that its other modules never shadow installed packages
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from instrumentation import NULL_METRICS, create_metrics  # noqa: E402
+
+
 if is_wandb_available():
     import wandb
 
@@ -144,6 +160,221 @@ def log_validation(
     return images
 
 
+class LatentCache:
+    """
+    On-disk cache of VAE latent distribution parameters (mean and logvar, as
+    returned by `vae.encode(...).latent_dist.parameters`) for every training
+    image, with an optional horizontally flipped view.
+
+    Layout of `cache_dir`: `moments.npy` of shape (rows, views, 2 * latent_channels, h, w)
+    in float16 and `index.json` mapping the SHA-1 of the image file to its row.
+    The array is memory-mapped lazily in each process, so it can be passed to
+    dataloader workers without copying.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.moments_path = os.path.join(cache_dir, "moments.npy")
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self._moments = None
+
+    def load_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    @property
+    def moments(self):
+        if self._moments is None:
+            self._moments = np.load(self.moments_path, mmap_mode="r")
+        return self._moments
+
+    def gather(self, rows, views):
+        return torch.from_numpy(np.ascontiguousarray(self.moments[rows, views])).float()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_moments"] = None
+        return state
+
+
+def latent_cache_dir(args):
+    # Latents depend on the VAE and on the preprocessing, so each setup gets its own cache
+    model_id = f"{args.pretrained_model_name_or_path}@{args.revision}@{args.variant}"
+    return os.path.join(
+        args.latent_cache_dir,
+        f"{hashlib.sha1(model_id.encode()).hexdigest()[:12]}_res{args.resolution}_{args.image_interpolation_mode}",
+    )
+
+
+def image_file_bytes(image):
+    if image["bytes"] is not None:
+        return image["bytes"]
+    with open(image["path"], "rb") as f:
+        return f.read()
+
+
+def latent_cache_keys(train_split, image_column, batch_size=1024):
+    """SHA-1 of the encoded image file of every example, in dataset order."""
+    raw_images = train_split.select_columns([image_column]).cast_column(image_column, datasets.Image(decode=False))
+    keys = []
+    # Batched iteration: only `batch_size` encoded images are held in memory at a time
+    for batch in raw_images.iter(batch_size=batch_size):
+        keys.extend(hashlib.sha1(image_file_bytes(image)).hexdigest() for image in batch[image_column])
+    return keys
+
+
+def latent_shape(vae, resolution):
+    # (2 * latent_channels, h, w) of `latent_dist.parameters` for a resolution x resolution image
+    downsample = 2 ** (len(vae.config.block_out_channels) - 1)
+    return (2 * vae.config.latent_channels, resolution // downsample, resolution // downsample)
+
+
+def fill_latent_cache(
+    cache,
+    keys,
+    train_split,
+    image_column,
+    cache_transforms,
+    vae,
+    num_views,
+    accelerator,
+    dtype,
+    batch_size,
+    resolution,
+):
+    """
+    Encode every image whose key is not in the cache yet. Must be called on every process: the
+    missing images are split across processes by `accelerator.process_index`, each process writes
+    its rows into a shared temporary array, and the main process then replaces the old array and
+    index atomically. Existing rows keep their positions and all their views.
+    """
+    index = cache.load_index()
+    old_moments = np.load(cache.moments_path, mmap_mode="r") if index else None
+    if old_moments is not None and old_moments.shape[1] < num_views:
+        raise ValueError(
+            f"Latent cache {cache.cache_dir} was built without --random_flip; remove it or use another"
+            " --latent_cache_dir."
+        )
+    # A cache built with --random_flip keeps the flipped view even if this run does not use it
+    cache_views = max(num_views, old_moments.shape[1]) if old_moments is not None else num_views
+
+    missing = {}
+    for example_idx, key in enumerate(keys):
+        if key not in index and key not in missing:
+            missing[key] = example_idx
+    if not missing:
+        return
+
+    missing_items = list(missing.items())
+    num_old = len(index)
+    tmp_path = cache.moments_path + ".tmp.npy"
+    if accelerator.is_main_process:
+        logger.info(f"Encoding {len(missing)} images into the latent cache at {cache.cache_dir}")
+        os.makedirs(cache.cache_dir, exist_ok=True)
+        new_moments = np.lib.format.open_memmap(
+            tmp_path,
+            mode="w+",
+            dtype=np.float16,
+            shape=(num_old + len(missing_items), cache_views) + latent_shape(vae, resolution),
+        )
+        for old_start in range(0, num_old, 1024):
+            new_moments[old_start : old_start + 1024] = old_moments[old_start : old_start + 1024]
+        new_moments.flush()
+        del new_moments
+    # Every index was read above, before the main process replaces it at the end
+    accelerator.wait_for_everyone()
+
+    raw_images = train_split.cast_column(image_column, datasets.Image(decode=False))
+    new_moments = np.load(tmp_path, mmap_mode="r+")
+    vae.to(accelerator.device, dtype=dtype)
+    # Rows are split across processes round-robin, by batch, so every process writes its own rows
+    starts = range(accelerator.process_index * batch_size, len(missing_items), accelerator.num_processes * batch_size)
+    for start in tqdm(starts, desc="Latent cache", disable=not accelerator.is_local_main_process):
+        chunk = missing_items[start : start + batch_size]
+        images = [
+            Image.open(io.BytesIO(image_file_bytes(raw_images[example_idx][image_column]))).convert("RGB")
+            for _, example_idx in chunk
+        ]
+        pixel_values = torch.stack([cache_transforms(image) for image in images]).to(accelerator.device, dtype=dtype)
+        views = [pixel_values]
+        if cache_views == 2:
+            # RandomHorizontalFlip on the PIL image equals flipping the normalized tensor along width
+            views.append(torch.flip(pixel_values, dims=[-1]))
+        with torch.no_grad():
+            moments = torch.stack([vae.encode(view).latent_dist.parameters for view in views], dim=1)
+        new_moments[num_old + start : num_old + start + len(chunk)] = moments.to("cpu", dtype=torch.float16).numpy()
+    new_moments.flush()
+    del new_moments, old_moments
+    vae.to("cpu")
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    accelerator.wait_for_everyone()
+
+    if accelerator.is_main_process:
+        for offset, (key, _) in enumerate(missing_items):
+            index[key] = num_old + offset
+        # The array is replaced first: an old index never points past the end of the new array
+        os.replace(tmp_path, cache.moments_path)
+        with open(cache.index_path + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(cache.index_path + ".tmp", cache.index_path)
+
+
+class CaptionEmbeddingCache:
+    """
+    Text-encoder outputs for a fixed list of captions, for when the text encoder is frozen.
+
+    If there are at most `max_size` captions they are all encoded once up front and a
+    batch of caption indices is a single gather. Otherwise embeddings are encoded on first
+    use and kept in an LRU of `max_size` entries.
+    """
+
+    def __init__(self, captions, tokenizer, text_encoder, max_size, encode_batch_size=64):
+        self.captions = captions
+        self.tokenizer = tokenizer
+        self.text_encoder = text_encoder
+        self.max_size = max_size
+        self.table = None
+        self.lru = OrderedDict()
+        if len(captions) <= max_size:
+            self.table = torch.cat(
+                [
+                    self._encode(range(start, min(start + encode_batch_size, len(captions))))
+                    for start in range(0, len(captions), encode_batch_size)
+                ]
+            )
+
+    @torch.no_grad()
+    def _encode(self, caption_indices):
+        # Same padding as tokenize_captions, so the embeddings match the uncached path
+        input_ids = self.tokenizer(
+            [self.captions[i] for i in caption_indices],
+            max_length=self.tokenizer.model_max_length,
+            padding="max_length",
+            truncation=True,
+            return_tensors="pt",
+        ).input_ids.to(self.text_encoder.device)
+        return self.text_encoder(input_ids, return_dict=False)[0]
+
+    def __call__(self, caption_index):
+        if self.table is not None:
+            return self.table[caption_index.to(self.table.device)]
+
+        caption_index = caption_index.tolist()
+        missing = [i for i in dict.fromkeys(caption_index) if i not in self.lru]
+        if missing:
+            for i, hidden_states in zip(missing, self._encode(missing)):
+                self.lru[i] = hidden_states
+        for i in caption_index:
+            self.lru.move_to_end(i)
+        hidden_states = torch.stack([self.lru[i] for i in caption_index])
+        while len(self.lru) > self.max_size:
+            self.lru.popitem(last=False)
+        return hidden_states
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Simple example of a training script.")
     parser.add_argument(
@@ -189,7 +420,10 @@ def parse_args():
         help=(
             "A folder containing the training data. Folder contents must follow the structure described in"
             " https://huggingface.co/docs/datasets/image_dataset#imagefolder. In particular, a `metadata.jsonl` file"
-            " must exist to provide the captions for the images. Ignored if `dataset_name` is specified."
+            " must exist to provide the captions for the images. A folder with `index.json` and Arrow shards written"
+            " by `prepare_dataset_for_finetuning.py --output_format=arrow` is also accepted; if it has train/val/test"
+            " split subfolders, the shards of `train` are used."
+            " Ignored if `dataset_name` is specified."
         ),
     )
     parser.add_argument(
@@ -418,6 +652,54 @@ def parse_args():
         default=4,
         help=("The dimension of the LoRA update matrices."),
     )
+    parser.add_argument(
+        "--latent_cache_dir",
+        type=str,
+        default=None,
+        help=(
+            "Directory for a one-time VAE latent cache. If set, the VAE encodes every training image (and its flipped"
+            " view with `--random_flip`) once before training, the training loop samples latents from the cached"
+            " mean/logvar, and the VAE is not kept on the training device. Requires `--center_crop`."
+        ),
+    )
+    parser.add_argument(
+        "--latent_cache_batch_size",
+        type=int,
+        default=8,
+        help="Batch size of the VAE when filling the latent cache.",
+    )
+    parser.add_argument(
+        "--caption_cache_size",
+        type=int,
+        default=256,
+        help=(
+            "Maximum number of caption embeddings kept on the device when the text encoder is frozen. If the dataset"
+            " has at most this many unique captions they are all encoded once before training; otherwise embeddings"
+            " are cached in an LRU of this size. Set to 0 to run the text encoder on every batch."
+        ),
+    )
+    parser.add_argument(
+        "--metrics_path",
+        type=str,
+        default=None,
+        help=(
+            "JSONL file for per-step timings (data loading, training step, checkpointing, validation), memory"
+            " high-water marks and a summary at the end of training. Written by the main process only."
+        ),
+    )
+    parser.add_argument(
+        "--profile_steps",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Global steps to trace with torch.profiler. Requires `--metrics_path`.",
+    )
+    parser.add_argument(
+        "--profile_dir",
+        type=str,
+        default=None,
+        help="Where to save profiler traces. Defaults to the directory of `--metrics_path`.",
+    )
     parser.add_argument(
         "--image_interpolation_mode",
         type=str,
@@ -436,10 +718,23 @@ def parse_args():
     # Sanity checks
     if args.dataset_name is None and args.train_data_dir is None:
         raise ValueError("Need either a dataset name or a training folder.")
+    if args.latent_cache_dir is not None and not args.center_crop:
+        raise ValueError("`--latent_cache_dir` requires `--center_crop`: random crops cannot be cached.")
 
     return args
 
 
+def arrow_train_dir(train_data_dir):
+    """
+    Folder with the Arrow shards and `index.json` to train on: `train_data_dir` itself, or its `train` split when
+    prepare_dataset_for_finetuning.py wrote train/val/test subfolders. None if there are no shards.
+    """
+    for candidate in (train_data_dir, os.path.join(train_data_dir, "train")):
+        if os.path.exists(os.path.join(candidate, "index.json")):
+            return candidate
+    return None
+
+
 DATASET_NAME_MAPPING = {
     "lambdalabs/naruto-blip-captions": ("image", "text"),
 }
@@ -463,6 +758,11 @@ def main():
         log_with=args.report_to,
         project_config=accelerator_project_config,
     )
+    metrics = (
+        create_metrics(args.metrics_path, args.profile_steps, args.profile_dir)
+        if accelerator.is_main_process
+        else NULL_METRICS
+    )
 
     # Disable AMP for MPS.
     if torch.backends.mps.is_available():
@@ -533,7 +833,9 @@ def main():
 
     # Move unet, vae and text_encoder to device and cast to weight_dtype
     unet.to(accelerator.device, dtype=weight_dtype)
-    vae.to(accelerator.device, dtype=weight_dtype)
+    if args.latent_cache_dir is None:
+        # With the latent cache the VAE is only moved to the device while the cache is being filled
+        vae.to(accelerator.device, dtype=weight_dtype)
     text_encoder.to(accelerator.device, dtype=weight_dtype)
 
     # Add adapter and make sure the trainable params are in float32.
@@ -604,6 +906,20 @@ def main():
             cache_dir=args.cache_dir,
             data_dir=args.train_data_dir,
         )
+    elif arrow_train_dir(args.train_data_dir) is not None:
+        # Sharded Arrow output of prepare_dataset_for_finetuning.py: shards are memory-mapped, no directory scan
+        arrow_dir = arrow_train_dir(args.train_data_dir)
+        with open(os.path.join(arrow_dir, "index.json")) as f:
+            shards = json.load(f)["shards"]
+        if not shards:
+            raise ValueError(f"{arrow_dir}/index.json does not list any shards.")
+        dataset = DatasetDict(
+            {
+                "train": concatenate_datasets(
+                    [Dataset.from_file(os.path.join(arrow_dir, shard["file"])) for shard in shards]
+                )
+            }
+        )
     else:
         data_files = {}
         if args.train_data_dir is not None:
@@ -641,7 +957,7 @@ def main():
 
     # Preprocessing the datasets.
     # We need to tokenize input captions and transform the images.
-    def tokenize_captions(examples, is_train=True):
+    def select_captions(examples, is_train=True):
         captions = []
         for caption in examples[caption_column]:
             if isinstance(caption, str):
@@ -653,6 +969,10 @@ def main():
                 raise ValueError(
                     f"Caption column `{caption_column}` should contain either strings or lists of strings."
                 )
+        return captions
+
+    def tokenize_captions(examples, is_train=True):
+        captions = select_captions(examples, is_train)
         inputs = tokenizer(
             captions, max_length=tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt"
         )
@@ -681,23 +1001,96 @@ def main():
         model = model._orig_mod if is_compiled_module(model) else model
         return model
 
+    def preprocess_captions(examples):
+        if caption_cache is not None:
+            examples["caption_index"] = [caption_to_index[caption] for caption in select_captions(examples)]
+        else:
+            examples["input_ids"] = tokenize_captions(examples)
+
     def preprocess_train(examples):
         images = [image.convert("RGB") for image in examples[image_column]]
         examples["pixel_values"] = [train_transforms(image) for image in images]
-        examples["input_ids"] = tokenize_captions(examples)
+        preprocess_captions(examples)
+        return examples
+
+    def preprocess_train_cached(examples):
+        preprocess_captions(examples)
         return examples
 
     with accelerator.main_process_first():
         if args.max_train_samples is not None:
             dataset["train"] = dataset["train"].shuffle(seed=args.seed).select(range(args.max_train_samples))
-        # Set the training transforms
-        train_dataset = dataset["train"].with_transform(preprocess_train)
+
+    latent_cache = None
+    if args.latent_cache_dir is not None:
+        latent_cache = LatentCache(latent_cache_dir(args))
+        cache_transforms = transforms.Compose(
+            [
+                transforms.Resize(args.resolution, interpolation=interpolation),
+                transforms.CenterCrop(args.resolution),
+                transforms.ToTensor(),
+                transforms.Normalize([0.5], [0.5]),
+            ]
+        )
+        num_views = 2 if args.random_flip else 1
+        keys = latent_cache_keys(dataset["train"], image_column)
+        # Every process encodes its share of the missing images
+        with metrics.stage("fill_latent_cache", sync=True):
+            fill_latent_cache(
+                latent_cache,
+                keys,
+                dataset["train"],
+                image_column,
+                cache_transforms,
+                vae,
+                num_views,
+                accelerator,
+                weight_dtype,
+                args.latent_cache_batch_size,
+                args.resolution,
+            )
+        accelerator.wait_for_everyone()
+        with accelerator.main_process_first():
+            index = latent_cache.load_index()
+            latent_rows = [index[key] for key in keys]
+            dataset["train"] = dataset["train"].remove_columns([image_column]).add_column("latent_row", latent_rows)
+
+    # The text encoder is frozen unless text-encoder LoRA training is added, in which case the cache must be bypassed
+    caption_cache = None
+    caption_to_index = {}
+    if args.caption_cache_size > 0 and not any(p.requires_grad for p in text_encoder.parameters()):
+        for caption in dataset["train"][caption_column]:
+            for c in [caption] if isinstance(caption, str) else caption:
+                caption_to_index.setdefault(c, len(caption_to_index))
+        caption_cache = CaptionEmbeddingCache(
+            list(caption_to_index), tokenizer, text_encoder, max_size=args.caption_cache_size
+        )
+        logger.info(
+            f"Caching text-encoder outputs for {len(caption_to_index)} unique captions"
+            f" ({'precomputed' if caption_cache.table is not None else 'LRU'})"
+        )
+
+    # Set the training transforms
+    train_dataset = dataset["train"].with_transform(
+        preprocess_train if latent_cache is None else preprocess_train_cached
+    )
 
     def collate_fn(examples):
+        if caption_cache is not None:
+            captions = {"caption_index": torch.tensor([example["caption_index"] for example in examples])}
+        else:
+            captions = {"input_ids": torch.stack([example["input_ids"] for example in examples])}
+        if latent_cache is not None:
+            rows = np.array([example["latent_row"] for example in examples])
+            # Each example picks its original or flipped view, like RandomHorizontalFlip would
+            if args.random_flip:
+                views = torch.randint(0, 2, (len(rows),)).numpy()
+            else:
+                views = np.zeros(len(rows), dtype=np.int64)
+            return {"latent_moments": latent_cache.gather(rows, views), **captions}
         pixel_values = torch.stack([example["pixel_values"] for example in examples])
         pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
-        input_ids = torch.stack([example["input_ids"] for example in examples])
-        return {"pixel_values": pixel_values, "input_ids": input_ids}
+        return {"pixel_values": pixel_values, **captions}
 
     # DataLoaders creation:
     train_dataloader = torch.utils.data.DataLoader(
@@ -801,10 +1194,15 @@ def main():
     for epoch in range(first_epoch, args.num_train_epochs):
         unet.train()
         train_loss = 0.0
-        for step, batch in enumerate(train_dataloader):
-            with accelerator.accumulate(unet):
+        for step, batch in enumerate(metrics.timed_iter("data", train_dataloader)):
+            step_timer = metrics.stage("step", global_step, sync=True)
+            with metrics.profile(global_step), step_timer, accelerator.accumulate(unet):
                 # Convert images to latent space
-                latents = vae.encode(batch["pixel_values"].to(dtype=weight_dtype)).latent_dist.sample()
+                if latent_cache is not None:
+                    latent_dist = DiagonalGaussianDistribution(batch["latent_moments"].to(dtype=weight_dtype))
+                else:
+                    latent_dist = vae.encode(batch["pixel_values"].to(dtype=weight_dtype)).latent_dist
+                latents = latent_dist.sample()
                 latents = latents * vae.config.scaling_factor
 
                 # Sample noise that we'll add to the latents
@@ -825,7 +1223,10 @@ def main():
                 noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
 
                 # Get the text embedding for conditioning
-                encoder_hidden_states = text_encoder(batch["input_ids"], return_dict=False)[0]
+                if caption_cache is not None:
+                    encoder_hidden_states = caption_cache(batch["caption_index"])
+                else:
+                    encoder_hidden_states = text_encoder(batch["input_ids"], return_dict=False)[0]
 
                 # Get the target for loss depending on the prediction type
                 if args.prediction_type is not None:
@@ -878,6 +1279,8 @@ def main():
             if accelerator.sync_gradients:
                 progress_bar.update(1)
                 global_step += 1
+                metrics.count("optimizer_steps")
+                metrics.sample_memory()
                 accelerator.log({"train_loss": train_loss}, step=global_step)
                 train_loss = 0.0
 
@@ -904,7 +1307,8 @@ def main():
                                     shutil.rmtree(removing_checkpoint)
 
                         save_path = os.path.join(args.output_dir, f"checkpoint-{global_step}")
-                        accelerator.save_state(save_path)
+                        with metrics.stage("checkpoint", global_step):
+                            accelerator.save_state(save_path)
 
                         unwrapped_unet = unwrap_model(unet)
                         unet_lora_state_dict = convert_state_dict_to_diffusers(
@@ -935,7 +1339,8 @@ def main():
                     variant=args.variant,
                     torch_dtype=weight_dtype,
                 )
-                images = log_validation(pipeline, args, accelerator, epoch)
+                with metrics.stage("validation", epoch, sync=True):
+                    images = log_validation(pipeline, args, accelerator, epoch)
 
                 del pipeline
                 torch.cuda.empty_cache()
@@ -984,6 +1389,7 @@ def main():
                 ignore_patterns=["step_*", "epoch_*"],
             )
 
+    metrics.close()
     accelerator.end_training()
 
 